@@ -0,0 +1,145 @@
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from facadeAgent.consumption import RunningConsumption
+
+
+# Stand-in for Model.SmartPlug when LPCv1 is not importable: one object per
+# device, its state in the instance __dict__. Only an estimate of the real plug.
+class StandInPlug:
+
+    def __init__(self, device_id, actuator):
+        self._device_id = device_id
+        self._actuator = actuator
+        self._max_power_rating = None
+        self._power_multiply_factor = 1.0
+        self._power = 0.0
+        self._status = None
+        self._energy = 0.0
+        self._command = None
+
+    def get_Power(self):
+        return self._power
+
+
+# Alternative evaluated for the consumption state: power and priority in
+# NumPy columns indexed by a slot per device id, instead of the two dicts of
+# RunningConsumption.
+class ArrayConsumption:
+
+    def __init__(self, capacity=64):
+        self._slots = {}
+        self._power = np.zeros(capacity)
+        self._priority = np.zeros(capacity, dtype=np.int32)
+        self._group_power = {}
+        self._total = 0.0
+
+    def add(self, device_id, priority, power=0.0):
+        if len(self._slots) == len(self._power):
+            self._power = np.concatenate([self._power, np.zeros(len(self._power))])
+            self._priority = np.concatenate([self._priority, np.zeros(len(self._priority), dtype=np.int32)])
+        slot = self._slots[device_id] = len(self._slots)
+        self._power[slot] = power
+        self._priority[slot] = priority
+        self._group_power[priority] = self._group_power.get(priority, 0.0) + power
+        self._total += power
+
+    def update(self, device_id, power):
+        slot = self._slots[device_id]
+        delta = power - self._power[slot]
+        if delta:
+            self._power[slot] = power
+            self._group_power[int(self._priority[slot])] += delta
+            self._total += delta
+
+    def resync(self):
+        count = len(self._slots)
+        for priority in self._group_power:
+            self._group_power[priority] = float(self._power[:count][self._priority[:count] == priority].sum())
+        self._total = float(self._power[:count].sum())
+
+
+def plug_class(lpc_path):
+    """
+    Returns (class, name): LPCv1 SmartPlug when importable, the stand-in otherwise.
+    """
+    if lpc_path:
+        sys.path.append(lpc_path)
+    try:
+        from Model.SmartPlug import SmartPlug
+        return SmartPlug, 'SmartPlug'
+    except ImportError:
+        return StandInPlug, 'stand-in'
+
+
+def device_rows(count):
+    return [(f'building{540 + i // 44}/NIRE_WeMo_cc_{i % 44 // 4 + 1}/w{i % 4 + 1}', i % 3 + 1, 100.0 + i % 7, 1.0)
+            for i in range(count)]
+
+
+def build_plugs(cls, rows):
+    plugs = {}
+    for device_id, priority, max_power, factor in rows:
+        plug = cls(device_id, None)
+        plug._max_power_rating = max_power
+        plug._power_multiply_factor = factor
+        plugs[device_id] = plug
+    return plugs
+
+
+def build_consumption(consumption, rows):
+    for device_id, priority, max_power, factor in rows:
+        consumption.add(device_id, priority)
+    # One publish per device, every device holds its own power value
+    for i, (device_id, priority, max_power, factor) in enumerate(rows):
+        consumption.update(device_id, i * 1.5 + 0.1)
+    return consumption
+
+
+def measure(build, rows):
+    """
+    Bytes allocated by build(rows), the device ids excluded.
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    state = build(rows)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return state, after - before
+
+
+def timed(function, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function()
+    return (time.perf_counter() - start) / rounds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-device memory of the plugs and of the agent consumption state, '
+                                                 'dicts vs NumPy columns')
+    parser.add_argument('--devices', type=int, nargs='+', default=[44, 1000, 10000])
+    parser.add_argument('--rounds', type=int, default=20, help='updates and resyncs timed per size')
+    parser.add_argument('--lpc-path', help='directory of LPCv1, to measure the real SmartPlug')
+    args = parser.parse_args()
+
+    cls, name = plug_class(args.lpc_path)
+    print(f'Plug objects: {name}' + ('' if cls is not StandInPlug else ' (LPCv1 not importable, estimate only)')
+          + ', not changed by this tree')
+    print(f"{'devices':>8} {'state':>12} {'bytes/device':>13} {'update us':>10} {'resync ms':>10}")
+    for count in args.devices:
+        rows = device_rows(count)
+        plugs, size = measure(lambda rows: build_plugs(cls, rows), rows)
+        print(f'{count:>8} {"plugs":>12} {size / count:>13.1f}')
+        powers = [(row[0], float(i % 1500)) for i, row in enumerate(rows)]
+        for label, factory in (('dicts', RunningConsumption), ('columns', ArrayConsumption)):
+            consumption, size = measure(lambda rows: build_consumption(factory(), rows), rows)
+            update = timed(lambda: [consumption.update(device_id, power) for device_id, power in powers], args.rounds)
+            resync = timed(consumption.resync, args.rounds)
+            print(f'{count:>8} {label:>12} {size / count:>13.1f} {update / count * 1e6:>10.3f} {resync * 1e3:>10.3f}')
@@ -0,0 +1,71 @@
+import argparse
+import time
+
+from facadeAgent.dispatch import TopicIndex
+
+
+# Stand-ins for Model.SmartPlug and Controller.DeviceMonitor: the monitor
+# notifies every observer, each plug keeps the messages of its own topic.
+class FakePlug:
+
+    def __init__(self, device_id):
+        self._prefix = 'devices/' + device_id + '/'
+        self.power = 0.0
+
+    def update(self, message):
+        if message['topic'].startswith(self._prefix):
+            self.power = message['message'][0]['power']
+
+
+class FakeMonitor:
+
+    def __init__(self):
+        self._observers = []
+
+    def register_Observer(self, observer):
+        self._observers.append(observer)
+
+    def process_Message(self, message):
+        for observer in self._observers:
+            observer.update(message)
+
+
+def device_ids(count, plugs_per_controller=4, controllers_per_building=11):
+    per_building = plugs_per_controller * controllers_per_building
+    return [f'building{540 + i // per_building}/NIRE_WeMo_cc_{i % per_building // plugs_per_controller + 1}/w{i % plugs_per_controller + 1}'
+            for i in range(count)]
+
+
+def bench_broadcast(ids, messages):
+    monitor = FakeMonitor()
+    for device_id in ids:
+        monitor.register_Observer(FakePlug(device_id))
+    start = time.perf_counter()
+    for topic, message in messages:
+        monitor.process_Message({'topic': topic, 'message': message})
+    return (time.perf_counter() - start) / len(messages)
+
+
+def bench_index(ids, messages):
+    index = TopicIndex()
+    for device_id in ids:
+        monitor = FakeMonitor()
+        monitor.register_Observer(FakePlug(device_id))
+        index.register(device_id, monitor)
+    start = time.perf_counter()
+    for topic, message in messages:
+        index.dispatch(topic, message)
+    return (time.perf_counter() - start) / len(messages)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-message cost of the observer fan-out vs the topic index')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[44, 440, 2200, 4400])
+    parser.add_argument('--messages', type=int, default=2000, help='publishes timed per size')
+    args = parser.parse_args()
+
+    print(f"{'devices':>8} {'broadcast us/msg':>17} {'index us/msg':>13}")
+    for size in args.sizes:
+        ids = device_ids(size)
+        messages = [(f'devices/{ids[i % size]}/all', [{'power': float(i)}, {}]) for i in range(args.messages)]
+        print(f'{size:>8} {bench_broadcast(ids, messages) * 1e6:>17.2f} {bench_index(ids, messages) * 1e6:>13.2f}')
@@ -0,0 +1,212 @@
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from facadeAgent.dispatch import TopicIndex
+from facadeAgent.lpc_kernel import DEFERRABLE, OFF, ON_STATUSES, decide
+from Telemetry_compact import SnapshotDecoder
+from Telemetry_thresholds import parse_command
+
+
+# Per-device reference loop, written from the same load priority rule as the
+# kernel (facadeAgent/lpc_kernel.py), walking the devices one by one. It is
+# not LoadPriorityControlEV: agreeing with it checks the vectorization, not
+# parity with the strategy. With --lpc-path, compare_lpc runs the recorded
+# snapshots through LoadPriorityControlEV itself.
+def decide_loop(power, priority, status, max_power, threshold):
+    devices = sorted(range(len(power)), key=lambda i: (priority[i] == DEFERRABLE, priority[i], i))
+    per_group = isinstance(threshold, dict)
+    budgets = {int(group): value for group, value in threshold.items()} if per_group else {None: threshold}
+    for i in devices:
+        if status[i] != OFF and status[i] not in ON_STATUSES:
+            group = priority[i] if per_group else None
+            if group in budgets:
+                budgets[group] -= power[i] if power[i] == power[i] else 0.0
+    used = dict.fromkeys(budgets, 0.0)
+    on = []
+    for i in devices:
+        group = priority[i] if per_group else None
+        is_on = status[i] in ON_STATUSES
+        if (status[i] != OFF and not is_on) or group not in budgets:
+            on.append((i, is_on))
+            continue
+        if not is_on and max_power[i] != max_power[i]:
+            on.append((i, False))
+            continue
+        measured = power[i] if power[i] == power[i] else 0.0
+        demand = measured if is_on and measured > 0 else max_power[i]
+        if demand != demand:
+            demand = measured
+        used[group] += demand
+        on.append((i, used[group] <= budgets[group]))
+    return np.array([value for i, value in sorted(on)], dtype=bool)
+
+
+def synthetic_inputs(count, seed=0):
+    rng = np.random.default_rng(seed)
+    priority = rng.integers(0, 4, count)
+    status = rng.choice([0, 1, 1, 1, 8, 11], count)
+    max_power = rng.choice([60.0, 100.0, 150.0, 1500.0, np.nan], count)
+    power = np.where(np.isin(status, ON_STATUSES), rng.uniform(0, 1600, count), 0.0)
+    power[rng.random(count) < 0.05] = np.nan
+    return power, priority, status, max_power
+
+
+def recorded_inputs(path):
+    """
+    Facade payloads stored by the historian, one JSON document per line (nested or compact),
+    as (device identifiers, control command, kernel inputs).
+    """
+    decoder = SnapshotDecoder()
+    with open(path) as lines:
+        for line in lines:
+            snapshot = decoder.decode(json.loads(line))
+            if snapshot is None:
+                continue
+            thresholds = parse_command(snapshot.cmd)
+            if thresholds is None:
+                continue
+            priority_thresholds, total = thresholds
+            yield (list(snapshot.identifiers), snapshot.cmd,
+                   (np.array([np.nan if value is None else value for value in snapshot.power], dtype=float),
+                    np.array([DEFERRABLE if value is None else value for value in snapshot.priority]),
+                    np.array([-1 if value is None else value for value in snapshot.status]),
+                    np.array([np.nan if value is None else value for value in snapshot.maxpower], dtype=float),
+                    priority_thresholds or total))
+
+
+# Stands in for the agent VIP object the LPCv1 devices actuate through:
+# set_point(requester_id, topic, value) is recorded instead of sent, like
+# the CommandBatcher does while the agent collects a strategy run.
+class RecordingActuator:
+
+    def __init__(self):
+        self.rpc = self
+        self.set_points = {}
+
+    def call(self, peer, method, *args, **kwargs):
+        if method == 'set_point':
+            self.set_points[args[1]] = args[2]
+        return self
+
+    def get(self, timeout=None):
+        return None
+
+
+def lpc_classes(lpc_path):
+    """
+    Returns (SmartPlug, IoTDeviceGroup, DeviceMonitor, EMSControl, LoadPriorityControlEV) from LPCv1,
+    None when it is not importable.
+    """
+    if lpc_path:
+        sys.path.append(lpc_path)
+    try:
+        from Model.SmartPlug import SmartPlug
+        from Model.IoTDeviceGroup import IoTDeviceGroup
+        from Controller.DeviceMonitor import DeviceMonitor
+        from Controller.EMSControl import EMSControl
+        from Controller.LoadPriorityControlEV import LoadPriorityControlEV
+    except ImportError:
+        return None
+    return SmartPlug, IoTDeviceGroup, DeviceMonitor, EMSControl, LoadPriorityControlEV
+
+
+def compare_lpc(classes, identifiers, cmd, inputs):
+    """
+    Runs LoadPriorityControlEV on one recorded snapshot, built the way the agent builds the facade,
+    and compares its set points with the kernel decision, as the agent does with lpc_shadow.
+    The EV charger is left out: its set points are not on / off. The plugs take their priority
+    from the LPCv1 device table, which must match the recorded one.
+
+    :returns: identifiers of the plugs where the strategy and the kernel disagree
+    """
+    SmartPlug, IoTDeviceGroup, DeviceMonitor, EMSControl, LoadPriorityControlEV = classes
+    power, priority, status, max_power, threshold = inputs
+    plugs = [i for i, identifier in enumerate(identifiers) if '/EV/' not in identifier]
+    actuator = RecordingActuator()
+    group = IoTDeviceGroup()
+    monitor = DeviceMonitor()
+    index = TopicIndex()
+    for i in plugs:
+        plug = SmartPlug(identifiers[i], actuator)
+        plug._max_power_rating = None if max_power[i] != max_power[i] else float(max_power[i])
+        group.add_Device(plug)
+        monitor.register_Observer(plug)
+        index.register(identifiers[i], monitor)
+    for i in plugs:
+        monitor.process_Message({'topic': f'devices/{identifiers[i]}/all',
+                                 'message': [{'power': None if power[i] != power[i] else float(power[i]),
+                                              'status': int(status[i])}, {}]})
+    controller = EMSControl()
+    controller.set_Controller(LoadPriorityControlEV(), cmd)
+    controller.set_Group(group)
+    controller.execute_Strategy()
+
+    commanded = {}
+    for topic, value in actuator.set_points.items():
+        device_id, _ = index.lookup(topic)
+        if device_id is not None:
+            commanded[device_id] = int(value) != OFF
+    plug_inputs = tuple(values[plugs] for values in (power, priority, status, max_power)) + (threshold,)
+    disagreeing = []
+    for i, on in zip(plugs, decide(*plug_inputs).on.tolist()):
+        current = int(status[i])
+        if current != OFF and current not in ON_STATUSES:
+            continue
+        if commanded.get(identifiers[i], current in ON_STATUSES) != on:
+            disagreeing.append(identifiers[i])
+    return disagreeing
+
+
+def timed(function, inputs, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function(*inputs)
+    return (time.perf_counter() - start) / rounds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load priority decision: vectorized kernel vs a per-device reference '
+                                                 'loop of the same rule, and vs LoadPriorityControlEV on recorded payloads')
+    parser.add_argument('--devices', type=int, nargs='+', default=[44, 1000, 5000, 10000])
+    parser.add_argument('--rounds', type=int, default=20, help='decisions timed per size')
+    parser.add_argument('--snapshots', help='JSON lines of recorded facade payloads, run through the kernel and the loop')
+    parser.add_argument('--lpc-path', help='directory of LPCv1, to run the recorded payloads through LoadPriorityControlEV')
+    args = parser.parse_args()
+
+    if args.snapshots:
+        checked = mismatches = 0
+        for identifiers, cmd, inputs in recorded_inputs(args.snapshots):
+            checked += 1
+            mismatches += not np.array_equal(decide(*inputs).on, decide_loop(*inputs))
+        print(f'{checked} recorded snapshots, {mismatches} decisions where the kernel and the reference loop differ')
+
+        classes = lpc_classes(args.lpc_path)
+        if classes is None:
+            print('LPCv1 not importable (--lpc-path), the kernel was not compared with LoadPriorityControlEV')
+        else:
+            runs = agreeing = plugs = 0
+            for identifiers, cmd, inputs in recorded_inputs(args.snapshots):
+                if not (isinstance(cmd, list) and cmd and cmd[0] == 'lpc'):
+                    continue  # another strategy was active
+                disagreeing = compare_lpc(classes, identifiers, cmd, inputs)
+                runs += 1
+                agreeing += not disagreeing
+                plugs += len(disagreeing)
+            print(f'LoadPriorityControlEV on {runs} recorded lpc snapshots: {agreeing} runs agree with the kernel, '
+                  f'{plugs} plug decisions differ')
+    print('Reference loop: the kernel rule written per device, not LoadPriorityControlEV, '
+          'which is compared with --snapshots and --lpc-path.')
+
+    print(f"{'devices':>8} {'threshold':>10} {'loop ms':>9} {'kernel ms':>10} {'same as loop':>13}")
+    for count in args.devices:
+        power, priority, status, max_power = synthetic_inputs(count)
+        total = float(np.nansum(power)) * 0.6
+        for name, threshold in (('facade', total), ('groups', {1: total / 2, 2: total / 4, 3: total / 8})):
+            inputs = (power, priority, status, max_power, threshold)
+            same = np.array_equal(decide(*inputs).on, decide_loop(*inputs))
+            print(f'{count:>8} {name:>10} {timed(decide_loop, inputs, args.rounds) * 1e3:>9.3f} '
+                  f'{timed(decide, inputs, args.rounds) * 1e3:>10.3f} {str(same):>13}')
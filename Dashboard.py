@@ -1,13 +1,20 @@
 from flask import Flask
 from dash import Dash, dcc, html,dash_table
 from dash.dependencies import Input, Output
-import mysql.connector
 import pandas as pd
+import numpy as np
 import json
 import pytz
 from datetime import datetime,timedelta
 import dash_bootstrap_components as dbc
 import plotly.express as px
+from Database_pool import get_db_connection
+from Telemetry_cache import TelemetryCache
+from Telemetry_compact import COMPACT_TOPIC
+from Telemetry_store import MonitorStore, MISSING
+from Telemetry_aggregate import aggregate_power
+from Telemetry_thresholds import ThresholdTimeline
+from Telemetry_rollup import PowerRollup, pick_resolution
 
 
 # Sample data for the pie chart
@@ -34,100 +41,49 @@ app.layout = html.Div([
     html.Div(id='page-content')
 ])
 
-# Database connection setup
-def get_db_connection():
-    connection = mysql.connector.connect(
-        host='192.168.10.52',
-        user='SANKA',
-        password='3Sssmalaka@!',
-        database='GLEAMM_NIRE'
-    )
-    return connection
+# Shared telemetry window for every callback in this worker process,
+# flattened once into a columnar store as the snapshots arrive
+power_rollup = PowerRollup('Power_rollup.sqlite')
+telemetry_cache = TelemetryCache(get_db_connection, topic=COMPACT_TOPIC, window=timedelta(hours=3), store=MonitorStore(), rollup=power_rollup)
+threshold_timeline = ThresholdTimeline()
 
 # Function to fetch data from the last 20 minutes
 def fetch_data_last_20_minutes():
-    connection = get_db_connection()
-    cursor = connection.cursor()
-
-    try:
-        query =""" SELECT ts, value_string FROM GLEAMM_NIRE.data  where topic_id=5 and  ts <= UTC_TIMESTAMP()   and ts >=date_sub( UTC_TIMESTAMP() , interval 3 hour) ORDER BY ts DESC """
-
-        cursor.execute(query)
-        rows = cursor.fetchall()
-
-        data_list = []
-        for row in rows:
-            ts, value_string = row
-            data = json.loads(value_string)
-            data_list.append((ts, data))
-
-        return data_list
-
-    finally:
-        cursor.close()
-        connection.close()
+    return telemetry_cache.get_view()
 
 # Helper function to convert timestamps based on selected timezone
-def convert_timestamps(data_list, timezone):
+def convert_timestamps(ts, timezone):
+    ts = pd.DatetimeIndex(ts)
     if timezone == 'Local':
         local_tz = pytz.timezone('America/New_York')  # Change this to your local timezone
-        data_list = [(ts.astimezone(local_tz) if isinstance(ts, datetime) else ts, data) for ts, data in data_list]
-    return data_list
-
-# Helper function to guess missing threshold values
-def guess_missing_thresholds(thresholds_list):
-    last_thresholds = None
-    for i, thresholds in enumerate(thresholds_list):
-        if thresholds is None:
-            if last_thresholds is not None:
-                thresholds_list[i] = last_thresholds
-        else:
-            last_thresholds = thresholds
-    return thresholds_list
-
-def guess_missing_thresholds_spit(control_commands):
-    priority_thresholds = {}
-    total_thresholds = []
-    last_priority_thresholds = None
-    last_total_threshold = None
-    
-    for command in control_commands:
-        if isinstance(command, dict):
-            current_priority_thresholds = {priority: cmd[1] for priority, cmd in command.items()}
-            last_priority_thresholds = current_priority_thresholds
-            total_thresholds.append(sum(cmd[1] for cmd in command.values()))
-        elif isinstance(command, list) and len(command) == 2:
-            last_total_threshold = command[1]
-            current_priority_thresholds = None
-            total_thresholds.append(last_total_threshold)
-        else:
-            current_priority_thresholds = last_priority_thresholds
-            total_thresholds.append(last_total_threshold)
-
-        # Update the priority thresholds dictionary
-        if current_priority_thresholds:
-            for priority, threshold in current_priority_thresholds.items():
-                if priority not in priority_thresholds:
-                    priority_thresholds[priority] = []
-                priority_thresholds[priority].append(threshold)
-        else:
-            for priority in priority_thresholds:
-                priority_thresholds[priority].append(None)
-
-    # Insert the latest thresholds at the end of the lists
-    if last_priority_thresholds:
-        for priority, threshold in last_priority_thresholds.items():
-            if priority in priority_thresholds:
-                priority_thresholds[priority][-1] = threshold
-            else:
-                priority_thresholds[priority] = [threshold]
-    
-    if last_total_threshold is not None:
-        total_thresholds[-1] = last_total_threshold
-    for priority in priority_thresholds:
-        priority_thresholds[priority].reverse()
-    total_thresholds.reverse()
-    return priority_thresholds, total_thresholds
+        ts = ts.tz_localize('UTC').tz_convert(local_tz)
+    return ts
+
+# Time ranges offered by the dashboard, in hours. Ranges longer than the raw
+# window are drawn from the 1 min / 15 min / 1 h rollups.
+range_options = [
+    {'label': 'Last 3 Hours', 'value': 3},
+    {'label': 'Last 6 Hours', 'value': 6},
+    {'label': 'Last Day', 'value': 24},
+    {'label': 'Last Week', 'value': 24 * 7},
+    {'label': 'Last Month', 'value': 24 * 30},
+]
+
+# Helper function to build min/mean/max traces from the power rollups
+def rollup_traces(kind, hours, timezone, name=str, band=True):
+    end = datetime.utcnow()
+    resolution = pick_resolution(timedelta(hours=hours))
+    series = power_rollup.read(kind, end - timedelta(hours=hours), end, resolution)
+    traces = []
+    for key, (bucket_ts, min_power, mean_power, max_power) in series.items():
+        x = convert_timestamps(bucket_ts, timezone)
+        if band:
+            traces.append({'x': x, 'y': max_power, 'mode': 'lines', 'line': {'width': 0},
+                           'name': f'{name(key)} max', 'showlegend': False})
+            traces.append({'x': x, 'y': min_power, 'mode': 'lines', 'line': {'width': 0}, 'fill': 'tonexty',
+                           'fillcolor': 'rgba(100, 100, 100, 0.15)', 'name': f'{name(key)} min', 'showlegend': False})
+        traces.append({'x': x, 'y': mean_power, 'mode': 'lines', 'name': name(key), 'line': {'width': 1.5}})
+    return traces
 
 # Home Page layout
 home_layout = html.Div(  
@@ -217,6 +173,13 @@ home_layout = html.Div(
         value='UTC',  # Default value
         style={'width': '50%', 'margin-bottom': '20px'}
     ),
+    dcc.Dropdown(
+        id='range-selector-home',
+        options=range_options,
+        value=3,  # Default value
+        clearable=False,
+        style={'width': '50%', 'margin-bottom': '20px'}
+    ),
     html.Div(id='control-command-display-home', style={'fontSize': 24, 'margin': '20px 0'}),
      dcc.Loading(
             id="loading-graphs",
@@ -257,6 +220,13 @@ device_layout = html.Div([
         value='UTC',  # Default value
         style={'width': '50%', 'margin-bottom': '20px'}
     ),
+    dcc.Dropdown(
+        id='range-selector-device',
+        options=range_options,
+        value=3,  # Default value
+        clearable=False,
+        style={'width': '50%', 'margin-bottom': '20px'}
+    ),
     html.Div(id='status-table-device'),
     dcc.Graph(id='power-trend-line-graph-device'),
 ])
@@ -279,74 +249,41 @@ device_layout = html.Div([
     Output('total-energy-consumption','children' )
       ],
     [Input('interval-component-home', 'n_intervals'),
-     Input('timezone-selector-home', 'value')]
+     Input('timezone-selector-home', 'value'),
+     Input('range-selector-home', 'value')]
 )
-def update_home_page(n, timezone):
-    data_list = fetch_data_last_20_minutes()
+def update_home_page(n, timezone, time_range=3):
+    time_range = time_range or 3
+    view = fetch_data_last_20_minutes()
 
-    if not data_list:
+    if not len(view):
         return "No control command available.", {}, {}
 
     # Convert timestamps based on selected timezone
-    data_list = convert_timestamps(data_list, timezone)
-
-    # Extract control commands and guess missing thresholds
-    control_commands = [data.get('Control', {}).get('Django', {}).get('cmd', None) for _, data in data_list]
-    LMP = data_list[0][1]['LMP']
-    one_hour_ago=data_list[0][0]-timedelta(hours=1)
-    filtered_tuples = [tup[1]['LMP'] for tup in data_list if tup[0] >= one_hour_ago]
-    LMP_average_for_last_hour=sum(filtered_tuples)/1000/len(filtered_tuples)
-    guessed_commands = guess_missing_thresholds(control_commands)
-
-    # Parse thresholds and prepare for display
-    thresholds_list = []
-    combined_threshold = None
-    for command in guessed_commands:
-        if isinstance(command, list) and len(command) == 2:
-            thresholds_list.append({'total': command[1]})
-            combined_threshold = command[1]  # Use this as the total consumption threshold
-        elif isinstance(command, dict):
-            thresholds_list.append({priority: cmd[1] for priority, cmd in command.items()})
-            combined_threshold = sum(cmd[1] for cmd in command.values())  # Combine thresholds for total consumption
-        else:
-            thresholds_list.append(None)
-
-    guessed_thresholds_list = guess_missing_thresholds(thresholds_list)
+    snapshot_ts = convert_timestamps(view.snapshot_ts, timezone)
+    row_ts = convert_timestamps(view.ts, timezone)
+
+    # Snapshots filled from the compact payload may carry no LMP (NaN)
+    reported_lmp = view.lmp[~np.isnan(view.lmp)]
+    LMP = reported_lmp[-1] if len(reported_lmp) else np.nan
+    one_hour_ago=snapshot_ts[-1]-timedelta(hours=1)
+    filtered_tuples = view.lmp[(snapshot_ts >= one_hour_ago) & ~np.isnan(view.lmp)]
+    LMP_average_for_last_hour=filtered_tuples.sum()/1000/len(filtered_tuples) if len(filtered_tuples) else np.nan
+    # Thresholds set by the control commands, carried forward in time
+    total_thresholds, priority_thresholds, current_thresholds = threshold_timeline.update(view)
 
     # Prepare display for thresholds
-    if guessed_thresholds_list[0]:
-        if 'total' in guessed_thresholds_list[0]:
-            thresholds_display = f"Current Threshold: Total Consumption <= {guessed_thresholds_list[0]['total']} W"
-        else:
-            thresholds_display = "Current Thresholds: " + ", ".join(
-                [f"Priority {priority} <= {threshold} W" for priority, threshold in guessed_thresholds_list[0].items()]
-            )
-    else:
+    if current_thresholds is None:
         thresholds_display = "No valid threshold command available."
-        
-    priority_thresholds_list, total_thresholds_list=guess_missing_thresholds_spit(control_commands)
+    elif not current_thresholds[0]:
+        thresholds_display = f"Current Threshold: Total Consumption <= {current_thresholds[1]} W"
+    else:
+        thresholds_display = "Current Thresholds: " + ", ".join(
+            [f"Priority {priority} <= {threshold} W" for priority, threshold in current_thresholds[0].items()]
+        )
 
     # Process data for total consumption and priority consumption
-    priority_trend_list = []
-    latest_data = data_list[0]
-    Evlatest=[]
-    for ts, data in data_list:
-        for monitor, buildings in data.get('Monitor', {}).items():
-            for building, devices in buildings.items():
-                for device, metrics in devices.items():
-                    priority_trend_list.append({
-                        'timestamp': ts,
-                        'priority': metrics.get('priority'),
-                        'power': metrics.get('power')
-                    })
-        # Handle EV data
-        for ev_device, metrics in data.get('Monitor', {}).get('EV', {}).items():
-            priority_trend_list.append({
-                'timestamp': ts,
-                'priority': metrics.get('priority'),
-                    'power' : round(metrics.get('power'),1)
-            })
-    tempdata=latest_data[1].get('Monitor', {}).get('building540',{}).get('EV',{}).get('building540/EV/JuiceBox')
+    tempdata=view.ev[-1] or {}
     Evpower=tempdata.get('power')
     Evenergy=tempdata.get('energy')
     Evstatus=tempdata.get('status')
@@ -354,7 +291,10 @@ def update_home_page(n, timezone):
     Evcurrent=tempdata.get('current')
     Evvoltage=tempdata.get('voltage')
     Evfrequency=tempdata.get('frequency')      
-    df_priority_trend = pd.DataFrame(priority_trend_list)
+    by_priority = aggregate_power(view, by='priority', mask=view.priority != MISSING)
+    reported = ~np.isnan(by_priority.total)
+    total_ts = snapshot_ts[reported]
+    total_power = by_priority.total[reported]
     # Create the priority trend line graph
     priority_trend_figure = {
         'data': [],
@@ -377,20 +317,18 @@ def update_home_page(n, timezone):
         }
     }
     
-    df_priority_grouped = df_priority_trend.groupby(['timestamp', 'priority']).sum().reset_index()
     pidata = {
     'Group': [],
     'Consumption': []
     }
     color_map = ['red', 'green', 'blue', 'orange', 'purple']  # Example colors for different thresholds
     color_idx = 0
-    for priority in df_priority_grouped['priority'].unique():
-        priority_data = df_priority_grouped[df_priority_grouped['priority'] == priority]
+    for priority, priority_power in zip(by_priority.keys, by_priority.values):
         try:
             if priority==0:
                  priority_trend_figure['data'].append({
-                    'x': priority_data['timestamp'],
-                    'y': priority_data['power'],
+                    'x': snapshot_ts,
+                    'y': priority_power,
                     'mode': 'lines',
                     'name': f'Differable Group',
                     'line': {'color': '#e303fc', 'width':1.5},
@@ -399,8 +337,8 @@ def update_home_page(n, timezone):
                 })               
             else:
                 priority_trend_figure['data'].append({
-                    'x': priority_data['timestamp'],
-                    'y': priority_data['power'],
+                    'x': snapshot_ts,
+                    'y': priority_power,
                     'mode': 'lines',
                     'name': f'Group {priority}',
                     'line': {'color': color_map[color_idx], 'width':1.5},
@@ -411,20 +349,13 @@ def update_home_page(n, timezone):
             pass
         color_idx += 1
         pidata['Group'].append('Differable Group') if priority==0 else pidata['Group'].append('Group'+str(priority))
-        pidata['Consumption'].append(df_priority_grouped[df_priority_grouped['priority'] == priority]['power'].iloc[-1])
+    pidata['Consumption'] = by_priority.latest
     
-    # Ensure that only one threshold per priority group is displayed
-    unique_thresholds = {}
-    for thresholds in guessed_thresholds_list:
-        if thresholds and 'total' not in thresholds:
-            for priority, threshold in thresholds.items():
-                unique_thresholds[priority] = threshold
-
     # Add threshold lines to priority trend graph
     color_idx = 0
-    for priority, threshold in priority_thresholds_list.items():
+    for priority, threshold in priority_thresholds.items():
         priority_trend_figure['data'].append({
-            'x': df_priority_grouped['timestamp'].unique(),
+            'x': snapshot_ts,
             'y': threshold,
             'mode': 'lines',
             'name': f'Threshold Priority {priority}',
@@ -435,13 +366,10 @@ def update_home_page(n, timezone):
         })
         color_idx += 1
 
-    # Calculate total power consumption by summing up all priority groups
-    df_total_consumption = df_priority_grouped.groupby('timestamp').sum().reset_index()
-
     # Create the total consumption line graph
     total_consumption_figure = {
         'data': [
-            {'x': df_total_consumption['timestamp'], 'y': df_total_consumption['power'], 'mode': 'lines', 'name': 'Total Consumption'},
+            {'x': total_ts, 'y': total_power, 'mode': 'lines', 'name': 'Total Consumption'},
         ],
         'layout': {
              'title': {
@@ -460,9 +388,9 @@ def update_home_page(n, timezone):
                 'font': {'size': 19, 'color': '#0e0180','weight': 'bold'}}
         }
     }
-    Latest_power_value =df_total_consumption['power'].iloc[-1]
-    last_hour_data = df_total_consumption[(df_total_consumption['timestamp'] > one_hour_ago) & (df_total_consumption['timestamp'] <= df_total_consumption['timestamp'].max())]
-    Last_hour_power_consumption=last_hour_data['power'].sum()/1000* 40 / 3600
+    Latest_power_value =total_power[-1]
+    last_hour_data = total_power[total_ts > one_hour_ago]
+    Last_hour_power_consumption=last_hour_data.sum()/1000* 40 / 3600
     Last_hour_usage_cost=LMP_average_for_last_hour*Last_hour_power_consumption
     Last_hour_usage_cost_text= 'Hourly Cost: ' + str(round(Last_hour_usage_cost,4))+ ' $' 
     print('Last Hour Cost of Usage ', Last_hour_usage_cost)
@@ -472,14 +400,20 @@ def update_home_page(n, timezone):
 
     # Add combined threshold line to total consumption graph if applicable
 
-    if total_thresholds_list:
+    if not np.isnan(total_thresholds).all():
         total_consumption_figure['data'].append({
-            'x': df_total_consumption['timestamp'].unique(),
-            'y': total_thresholds_list,
+            'x': snapshot_ts,
+            'y': total_thresholds,
             'mode': 'lines',
             'name': f'Combined Threshold',
             'line': {'dash': 'dash', 'color': 'red'}
         })
+
+    # Long ranges come from the rollups, with a bounded number of points
+    if pick_resolution(timedelta(hours=time_range)) is not None:
+        priority_trend_figure['data'] = rollup_traces('priority', time_range, timezone,
+                                                      name=lambda key: 'Differable Group' if key == '0' else f'Group {key}')
+        total_consumption_figure['data'] = rollup_traces('total', time_range, timezone, name=lambda key: 'Total Consumption')
         
     # Create a pie chart using Plotly Express
     fig1 = px.pie(
@@ -524,7 +458,7 @@ def update_home_page(n, timezone):
     
     instance_cost_text= 'Instantaneous Electricity Cost: '+ str(round(LMP/1000*Latest_power_value/1000*40/3600,5)) + ' $'
     return [thresholds_display, total_consumption_figure, priority_trend_figure, ev_power_display,f"EV Energy Consumption: {round(Evenergy/1000,2)} kWh" ,ev_status_display, 
-            {'color': 'red','fontSize': 30, 'margin': '10px 0'} if  Evstatus ==2 else  {'color':'green','fontSize': 30, 'margin': '10px 0'},f'Voltage: {Evvoltage/10}V , Current: {Evcurrent/10}A , Frequency {Evfrequency/100}Hz ',
+            {'color': 'red','fontSize': 30, 'margin': '10px 0'} if  Evstatus ==2 else  {'color':'green','fontSize': 30, 'margin': '10px 0'},f'Voltage: {Evvoltage/10}V , Current: {Evcurrent/10}A , Frequency {Evfrequency/100}Hz ' if None not in (Evvoltage, Evcurrent, Evfrequency) else 'Voltage, Current, Frequency: not reported',
             fig1,Latest_power_value_text, 'Unit Price: '+(str(round(LMP/1000,3))+' $/kWh'), instance_cost_text,Last_hour_usage_cost_text,
             'Total Energy Consumption: '+ str(round(Last_hour_power_consumption,2))+' kWh']
 # Device Page callback
@@ -532,43 +466,30 @@ def update_home_page(n, timezone):
     [Output('status-table-device', 'children'),
      Output('power-trend-line-graph-device', 'figure')],
     [Input('interval-component-device', 'n_intervals'),
-     Input('timezone-selector-device', 'value')]
+     Input('timezone-selector-device', 'value'),
+     Input('range-selector-device', 'value')]
 )
-def update_device_page(n, timezone):
-    data_list = fetch_data_last_20_minutes()
+def update_device_page(n, timezone, time_range=3):
+    time_range = time_range or 3
+    view = fetch_data_last_20_minutes()
 
-    if not data_list:
+    if not len(view):
         return {}, {}
 
     # Convert timestamps based on selected timezone
-    data_list = convert_timestamps(data_list, timezone)
+    snapshot_ts = convert_timestamps(view.snapshot_ts, timezone)
 
     # Prepare data for status bar graph and device power trends
-    latest_ts, latest_data = data_list[0]
-    status_data_list = []
-    power_trend_list = []
-
-    for ts, data in data_list:
-        for monitor, buildings in data.get('Monitor', {}).items():
-            for building, devices in buildings.items():
-                for device, metrics in devices.items():
-                    power_trend_list.append({
-                        'timestamp': ts,
-                        'device': device,
-                        'power': metrics.get('power')
-                    })
-    for monitor, buildings in latest_data.get('Monitor', {}).items():
-        for building, devices in buildings.items():
-            for device, metrics in devices.items():
-                status_data_list.append({
-                    'device': device,
-                    'status': metrics.get('status'),
-                    'priority':metrics.get('priority'),
-                    'power' : round(metrics.get('power'),1),
-                    'maxpower': round(metrics.get('maxpower'),1)
-                })
-    df_status = pd.DataFrame(status_data_list)
-    df_power_trend = pd.DataFrame(power_trend_list)
+    device_labels = np.array(view.device_labels, dtype=object)
+    latest = view.latest_rows()
+    df_status = pd.DataFrame({
+        'device': device_labels[view.device[latest]],
+        'status': view.status[latest],
+        'priority': view.priority[latest],
+        'power': view.power[latest].round(1),
+        'maxpower': view.maxpower[latest].round(1)
+    })
+    by_device = aggregate_power(view, by='device')
 
     # Define the style data conditional formatting for the table
     style_data_conditional = [
@@ -642,15 +563,18 @@ def update_device_page(n, timezone):
         }
     }
 
-    for device in df_power_trend['device'].unique():
-        device_data = df_power_trend[df_power_trend['device'] == device]
+    for device, device_power in zip(by_device.keys, by_device.values):
         power_trend_figure['data'].append({
-            'x': device_data['timestamp'],
-            'y': device_data['power'],
+            'x': snapshot_ts,
+            'y': device_power,
             'mode': 'lines',
-            'name': device
+            'name': device_labels[device]
         })
 
+    # Long ranges come from the rollups, with a bounded number of points
+    if pick_resolution(timedelta(hours=time_range)) is not None:
+        power_trend_figure['data'] = rollup_traces('device', time_range, timezone, band=False)
+
     return status_table, power_trend_figure
 
 # Update page layout based on URL
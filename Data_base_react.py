@@ -1,160 +1,312 @@
-import mysql.connector
+import argparse
 import json
 import csv
 import os
+from datetime import datetime, timedelta
 
-# Create a directory to store the output files
-output_dir = 'output_data'
-os.makedirs(output_dir, exist_ok=True)
+from Database_pool import get_db_connection, topic_id_of
+from Device_registry import DeviceRegistry
+from Telemetry_compact import COMPACT_TOPIC, SnapshotDecoder, merge_snapshots
 
-# Connect to MySQL
-connection = mysql.connector.connect(
-    host='192.168.10.52',
-    user='SANKA',
-    password='3Sssmalaka@!',
-    database='GLEAMM_NIRE'
-)
-
-# Prepare a list to store processed data
-processed_data = []
 try:
-    cursor = connection.cursor()
-    # Query to get the JSON data from the past 2 hours
-    cursor.execute("""
-        SELECT ts, topic_id, value_string 
-        FROM data 
-        WHERE topic_id = 5 AND ts >= NOW() - INTERVAL 2 HOUR 
-        ORDER BY ts DESC
-    """)
-    rows = cursor.fetchall()
-
-    # Initialize dictionaries to store processed data by w_key
-    w_key_data = {}
-    total_power_consumption = {}
-    priority_power_consumption = {}
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+DEVICE_FIELDNAMES = ['ts', 'id', 'identifier', 'power', 'status', 'priority', 'command']
+TOTAL_FIELDNAMES = ['ts', 'total_power', 'control_command']
+PRIORITY_LONG_FIELDNAMES = ['ts', 'priority', 'power', 'control']
+# The agent repeats the layout message of the compact payload every 10 minutes
+LAYOUT_LOOKBACK = timedelta(minutes=11)
+
+
+# Flatten one facade snapshot into device rows, totals and control thresholds,
+# None for the layout messages of the compact payload
+def flatten_snapshot(json_data, decoder):
+    snapshot = decoder.decode(json_data)
+    if snapshot is None:
+        return None
+    control_data = snapshot.cmd
+
+    # Extract control commands for total power consumption
+    control_command_total = None
+    if isinstance(control_data, list) and control_data[0] == 'lpc':
+        control_command_total = control_data[1]
     control_command_per_priority = {}
-    control_command_total = {}
-    all_priorities = set()
-
-    for row in reversed(rows):
-        ts = row[0]
-        id = row[1]
-        json_data = json.loads(row[2])  # Load the JSON string into a Python dictionary
-
-        # Navigate to the specific parts of the JSON
-        monitor_data = json_data.get('Monitor', {}).get('building540', {})
-        control_data = json_data.get('Control', {}).get('Django', {}).get('cmd', {})
-        # Extract control commands for total power consumption
-        control_command_total[ts] = None
-        if isinstance(control_data, list) and control_data[0] == 'lpc':
-                control_command_total[ts] = control_data[1]
-
-        # Iterate over each device in the monitor_data
-        for device, device_data_dict in monitor_data.items():
-            for w_key, w_values in device_data_dict.items():
-                identifier = f"building540/{device}/{w_key}"
-                power = w_values.get('power', 0.0)
-                status = w_values.get('status', None)
-                priority = w_values.get('priority', None)
-                command = w_values.get('command', None)
-
-                # Track all priority levels
-                if priority is not None:
-                    all_priorities.add(priority)
-
-                # Create the full path directory for each identifier if it doesn't exist
-                device_dir = os.path.join(output_dir, f'building540/{device}')
-                os.makedirs(device_dir, exist_ok=True)
-
-                # Store data in the w_key-specific list
-                if w_key not in w_key_data:
-                    w_key_data[w_key] = []
-
-                w_key_data[w_key].append({
-                    'ts': ts,
-                    'id': id,
-                    'identifier': identifier,
-                    'power': power,
-                    'status': status,
-                    'priority': priority,
-                    'command': command
-                })
-
-                # Update total power consumption
-                if ts not in total_power_consumption:
-                    total_power_consumption[ts] = 0.0
-                total_power_consumption[ts] += power
-
-                # Update power consumption per priority
-                if ts not in priority_power_consumption:
-                    priority_power_consumption[ts] = {}
-                if ts not in control_command_per_priority:
-                    control_command_per_priority[ts] = {}
-                if priority not in priority_power_consumption[ts]:
-                    priority_power_consumption[ts][priority] = 0.0
-                   # control_command_per_priority[ts][priority] = None
-
-                priority_power_consumption[ts][priority] += power
-
-                # Extract control commands per priority
-                if isinstance(control_data, dict) :
-                    for key in control_data:
-                        control_command_per_priority[ts][key] = control_data[key][1]
-                    control_command_total[ts]=sum(control_command_per_priority[ts].values())
-                #print(control_command_per_priority)
-
-finally:
-    cursor.close()
-    connection.close()
-
-# Save each w_key's data to separate CSV files under their respective directories
-for w_key, data in w_key_data.items():
-    # Determine the device directory based on the first entry's identifier
-    first_entry = data[0]
-    device_path = '/'.join(first_entry['identifier'].split('/')[:-1])  # Get path without the w_key
-    csv_file_name = os.path.join(output_dir, device_path, f'{w_key}.csv')
-
-    # Ensure the directory exists
-    os.makedirs(os.path.dirname(csv_file_name), exist_ok=True)
-
-    with open(csv_file_name, 'w', newline='') as csvfile:
-        fieldnames = ['ts', 'id', 'identifier', 'power', 'status', 'priority', 'command']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-        writer.writeheader()
-        for entry in data:
-            writer.writerow(entry)
-
-    print(f"Data for {w_key} has been successfully saved to {csv_file_name}.")
-
-# Save total power consumption and control command to a CSV file in the base directory
-csv_file_name = os.path.join(output_dir, 'total_power_consumption.csv')
-with open(csv_file_name, 'w', newline='') as csvfile:
-    fieldnames = ['ts', 'total_power', 'control_command']
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-    writer.writeheader()
-    for ts, total_power in total_power_consumption.items():
-        writer.writerow({'ts': ts, 'total_power': total_power, 'control_command': control_command_total.get(ts, None)})
-        #print(control_command_total)
-
-print(f"Total power consumption and control command has been successfully saved to {csv_file_name}.")
-
-# Prepare to save power consumption per priority group with separate columns for each priority and control command
-priority_columns = sorted(all_priorities)  # Sort priorities for consistent column ordering
-priority_fieldnames = ['ts'] + [f'priority_{p}_power' for p in priority_columns] + [f'priority_{p}_control' for p in priority_columns]
-
-csv_file_name = os.path.join(output_dir, 'priority_power_consumption.csv')
-with open(csv_file_name, 'w', newline='') as csvfile:
-    writer = csv.DictWriter(csvfile, fieldnames=priority_fieldnames)
-
-    writer.writeheader()
-    for ts, priorities in priority_power_consumption.items():
-        row = {'ts': ts}
-        for priority in priority_columns:
-            row[f'priority_{priority}_power'] = priorities.get(priority, 0.0)
-            row[f'priority_{priority}_control'] = control_command_per_priority.get(ts, {}).get(str(priority))
-            #print(priority,control_command_per_priority.get(ts, {}).get(str(priority)))
-        writer.writerow(row)
-
-print(f"Power consumption per priority group and control command has been successfully saved to {csv_file_name}.")
\ No newline at end of file
+    if isinstance(control_data, dict) and snapshot.identifiers:
+        control_command_per_priority = {key: control_data[key][1] for key in control_data}
+        control_command_total = sum(control_command_per_priority.values())
+
+    device_rows = []
+    total_power = 0.0
+    priority_power = {}
+    for identifier, power, status, priority, command in zip(snapshot.identifiers, snapshot.power, snapshot.status,
+                                                            snapshot.priority, snapshot.command):
+        power = 0.0 if power is None else power
+        device_rows.append((identifier, power, status, priority, command))
+        total_power += power
+        priority_power[priority] = priority_power.get(priority, 0.0) + power
+
+    if not snapshot.identifiers:
+        total_power = None
+    return device_rows, total_power, priority_power, control_command_total, control_command_per_priority
+
+
+# Streaming exporter of the facade snapshots stored in the historian.
+#
+# Rows are read with an unbuffered (server side) cursor in chunks and every
+# snapshot is written out as soon as it is read: one CSV per device, the total
+# power CSV and the priority power CSV. Memory stays flat, so days or weeks of
+# history can be exported, not just the last 2 hours.
+class SnapshotExporter:
+
+    def __init__(self, output_dir, registry=None):
+        self._output_dir = output_dir
+        self._registry = registry if registry is not None else DeviceRegistry()
+        self._decoder = SnapshotDecoder()
+        self._device_files = {}
+        self._device_writers = {}
+        self._all_priorities = set()
+        os.makedirs(output_dir, exist_ok=True)
+
+        self._total_file = open(os.path.join(output_dir, 'total_power_consumption.csv'), 'w', newline='')
+        self._total_writer = csv.DictWriter(self._total_file, fieldnames=TOTAL_FIELDNAMES)
+        self._total_writer.writeheader()
+
+        # Priority columns are only known at the end, spool them in long format and pivot in close()
+        self._priority_long_path = os.path.join(output_dir, 'priority_power_consumption.long.csv')
+        self._priority_long_file = open(self._priority_long_path, 'w', newline='')
+        self._priority_long_writer = csv.DictWriter(self._priority_long_file, fieldnames=PRIORITY_LONG_FIELDNAMES)
+
+    def _device_writer(self, identifier):
+        # Keyed by registry id: devices sharing a w_key on different controllers get their own file
+        device_id = self._registry.id_of(identifier)
+        writer = self._device_writers.get(device_id)
+        if writer is None:
+            csv_file_name = os.path.join(self._output_dir, f'{identifier}.csv')
+            os.makedirs(os.path.dirname(csv_file_name), exist_ok=True)
+            self._device_files[device_id] = open(csv_file_name, 'w', newline='')
+            writer = csv.DictWriter(self._device_files[device_id], fieldnames=DEVICE_FIELDNAMES)
+            writer.writeheader()
+            self._device_writers[device_id] = writer
+        return writer
+
+    def write_snapshot(self, ts, id, json_data):
+        flat = flatten_snapshot(json_data, self._decoder)
+        if flat is None:
+            return
+        device_rows, total_power, priority_power, control_command_total, control_command_per_priority = flat
+
+        for identifier, power, status, priority, command in device_rows:
+            # Track all priority levels
+            if priority is not None:
+                self._all_priorities.add(priority)
+
+            self._device_writer(identifier).writerow({
+                'ts': ts,
+                'id': id,
+                'identifier': identifier,
+                'power': power,
+                'status': status,
+                'priority': priority,
+                'command': command
+            })
+
+        if total_power is not None:
+            self._total_writer.writerow({'ts': ts, 'total_power': total_power, 'control_command': control_command_total})
+        for priority, power in priority_power.items():
+            self._priority_long_writer.writerow({'ts': ts, 'priority': priority, 'power': power,
+                                                 'control': control_command_per_priority.get(str(priority))})
+
+    def close(self):
+        for device_file in self._device_files.values():
+            device_file.close()
+        self._total_file.close()
+        self._priority_long_file.close()
+        self._write_priority_csv()
+        print(f"Data for {len(self._device_files)} devices and the total power consumption have been saved to {self._output_dir}.")
+
+    def _write_priority_csv(self):
+        # Pivot the long spool into one row per ts with a power and a control column per priority
+        priority_columns = sorted(self._all_priorities)  # Sort priorities for consistent column ordering
+        priority_fieldnames = ['ts'] + [f'priority_{p}_power' for p in priority_columns] + [f'priority_{p}_control' for p in priority_columns]
+        csv_file_name = os.path.join(self._output_dir, 'priority_power_consumption.csv')
+        known_priorities = {str(p) for p in priority_columns}
+        with open(csv_file_name, 'w', newline='') as csvfile, open(self._priority_long_path, newline='') as longfile:
+            writer = csv.DictWriter(csvfile, fieldnames=priority_fieldnames)
+            writer.writeheader()
+            row = None
+            for entry in csv.DictReader(longfile, fieldnames=PRIORITY_LONG_FIELDNAMES):
+                if row is None or row['ts'] != entry['ts']:
+                    if row is not None:
+                        writer.writerow(row)
+                    row = {'ts': entry['ts']}
+                    for priority in priority_columns:
+                        row[f'priority_{priority}_power'] = 0.0
+                if entry['priority'] in known_priorities:
+                    row[f"priority_{entry['priority']}_power"] = entry['power']
+                    row[f"priority_{entry['priority']}_control"] = entry['control'] or None
+            if row is not None:
+                writer.writerow(row)
+        os.remove(self._priority_long_path)
+        print(f"Power consumption per priority group and control command has been successfully saved to {csv_file_name}.")
+
+
+# Partitioned, compressed Parquet exporter.
+#
+# Device samples go to devices/date=YYYY-MM-DD/device=<building>.<controller>.<w_key>/,
+# totals and per-priority power (long format) to totals/date=.../ and
+# priority/date=.../. Rows are buffered per day and written as new part files,
+# so a re-run only appends the time range exported since the last run.
+class ParquetExporter:
+
+    STATE_FILE = '_last_ts'
+
+    def __init__(self, output_dir, flush_rows=200000, registry=None):
+        if pa is None:
+            raise RuntimeError("The parquet format needs pyarrow: pip install pyarrow")
+        self._output_dir = output_dir
+        self._registry = registry if registry is not None else DeviceRegistry()
+        self._decoder = SnapshotDecoder()
+        self._flush_rows = flush_rows
+        self._date = None
+        self._last_ts = None
+        self._reset_buffers()
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _reset_buffers(self):
+        self._devices = {}  # registry id -> {column: []}
+        self._totals = {'ts': [], 'total_power': [], 'control_command': []}
+        self._priority = {'ts': [], 'priority': [], 'power': [], 'control': []}
+        self._buffered_rows = 0
+
+    def last_exported_ts(self):
+        """
+        Returns the ts of the last snapshot written by a previous run, or None.
+        """
+        state_path = os.path.join(self._output_dir, self.STATE_FILE)
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path) as state_file:
+            return datetime.fromisoformat(state_file.read().strip())
+
+    def write_snapshot(self, ts, id, json_data):
+        date = ts.date()
+        if self._date is not None and (date != self._date or self._buffered_rows >= self._flush_rows):
+            self._flush()
+        self._date = date
+
+        flat = flatten_snapshot(json_data, self._decoder)
+        if flat is None:
+            return
+        device_rows, total_power, priority_power, control_command_total, control_command_per_priority = flat
+        for identifier, power, status, priority, command in device_rows:
+            columns = self._devices.setdefault(self._registry.id_of(identifier), {'ts': [], 'id': [], 'power': [], 'status': [], 'priority': [], 'command': []})
+            columns['ts'].append(ts)
+            columns['id'].append(id)
+            columns['power'].append(power)
+            columns['status'].append(status)
+            columns['priority'].append(priority)
+            columns['command'].append(command)
+        if total_power is not None:
+            self._totals['ts'].append(ts)
+            self._totals['total_power'].append(total_power)
+            self._totals['control_command'].append(control_command_total)
+        for priority, power in priority_power.items():
+            self._priority['ts'].append(ts)
+            self._priority['priority'].append(priority)
+            self._priority['power'].append(power)
+            self._priority['control'].append(control_command_per_priority.get(str(priority)))
+        self._buffered_rows += len(device_rows)
+        self._last_ts = ts
+
+    def _write_part(self, directory, columns, schema):
+        os.makedirs(directory, exist_ok=True)
+        table = pa.table(columns, schema=schema)
+        first, last = min(columns['ts']), max(columns['ts'])
+        part_name = f"part-{first:%Y%m%dT%H%M%S}-{last:%Y%m%dT%H%M%S}.parquet"
+        pq.write_table(table, os.path.join(directory, part_name), compression='zstd', use_dictionary=True)
+
+    def _flush(self):
+        if self._date is None:
+            return
+        date = f"date={self._date.isoformat()}"
+        device_schema = pa.schema([('ts', pa.timestamp('ms')), ('id', pa.int32()), ('power', pa.float32()),
+                                   ('status', pa.int16()), ('priority', pa.int16()), ('command', pa.int16())])
+        for device_id, columns in self._devices.items():
+            partition = self._registry.identifier_of(device_id).replace('/', '.')
+            self._write_part(os.path.join(self._output_dir, 'devices', date, f"device={partition}"), columns, device_schema)
+        if self._totals['ts']:
+            totals_schema = pa.schema([('ts', pa.timestamp('ms')), ('total_power', pa.float32()), ('control_command', pa.float32())])
+            self._write_part(os.path.join(self._output_dir, 'totals', date), self._totals, totals_schema)
+        if self._priority['ts']:
+            priority_schema = pa.schema([('ts', pa.timestamp('ms')), ('priority', pa.int16()), ('power', pa.float32()), ('control', pa.float32())])
+            self._write_part(os.path.join(self._output_dir, 'priority', date), self._priority, priority_schema)
+        self._reset_buffers()
+
+    def close(self):
+        self._flush()
+        if self._last_ts is not None:
+            with open(os.path.join(self._output_dir, self.STATE_FILE), 'w') as state_file:
+                state_file.write(self._last_ts.isoformat())
+        print(f"Parquet export up to {self._last_ts} has been saved to {self._output_dir}.")
+
+
+def export(output_dir='output_data', hours=2, chunk_size=500, output_format='csv'):
+    exporter = ParquetExporter(output_dir) if output_format == 'parquet' else SnapshotExporter(output_dir)
+    since = exporter.last_exported_ts() if output_format == 'parquet' else None
+
+    connection = get_db_connection()
+    # The compact payload is the primary stream, the cycles missing from it
+    # (the history older than it) are taken from the nested snapshots (topic 5)
+    compact_topic_id = topic_id_of(connection, COMPACT_TOPIC)
+    query_cursor = connection.cursor()
+    try:
+        if since is None:
+            query_cursor.execute("SELECT NOW() - INTERVAL %s HOUR", (hours,))
+            since = query_cursor.fetchone()[0]
+            include = lambda ts: ts >= since
+        else:
+            # Only the time range exported since the last run
+            include = lambda ts: ts > since
+    finally:
+        query_cursor.close()
+    # Unbuffered cursor: rows stay on the server until fetched
+    cursor = connection.cursor(buffered=False)
+    try:
+        # Oldest first, from the last layout message the first compact snapshots need
+        cursor.execute("""
+            SELECT ts, topic_id, value_string
+            FROM data
+            WHERE topic_id IN (%s, 5) AND ts >= %s
+            ORDER BY ts ASC
+        """, (compact_topic_id, since - LAYOUT_LOOKBACK))
+
+        def fetched_rows():
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for ts, id, value_string in rows:
+                    yield ts, id, json.loads(value_string)
+
+        for ts, id, json_data in merge_snapshots(fetched_rows(), 5):
+            if include(ts) or 'devices' in json_data:
+                exporter.write_snapshot(ts, id, json_data)
+    finally:
+        cursor.close()
+        connection.close()
+        exporter.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the facade history to CSV or partitioned Parquet files')
+    parser.add_argument('--output-dir', default='output_data', help='directory to store the output files')
+    parser.add_argument('--hours', type=int, default=2, help='how many hours of history to export')
+    parser.add_argument('--chunk-size', type=int, default=500, help='rows fetched from MySQL at a time')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                        help='parquet appends only the range exported since the last run')
+    args = parser.parse_args()
+    export(args.output_dir, args.hours, args.chunk_size, args.format)
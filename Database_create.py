@@ -37,6 +37,14 @@ CREATE TABLE IF NOT EXISTS devices (
 )
 ''')
 
+# Indexes for the lookups by building, controller and priority
+cursor.execute('CREATE INDEX IF NOT EXISTS idx_devices_building_id ON devices (building_id)')
+cursor.execute('CREATE INDEX IF NOT EXISTS idx_devices_controller_id ON devices (controller_id)')
+cursor.execute('CREATE INDEX IF NOT EXISTS idx_devices_priority ON devices (priority)')
+
+# WAL journal, readers do not block the writer
+cursor.execute('PRAGMA journal_mode=WAL')
+
 # Commit the changes
 conn.commit()
 
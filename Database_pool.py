@@ -0,0 +1,94 @@
+import logging
+import threading
+import time
+
+import mysql.connector
+from mysql.connector import pooling
+
+_log = logging.getLogger(__name__)
+
+
+# Connection settings of the GLEAMM_NIRE historian database
+DB_CONFIG = {
+    'host': '192.168.10.52',
+    'user': 'SANKA',
+    'password': '3Sssmalaka@!',
+    'database': 'GLEAMM_NIRE',
+}
+
+
+# Shared, bounded pool of MySQL connections.
+#
+# Connections are opened once per process and handed out again on every
+# request, instead of paying the TCP and auth setup on every callback. A
+# checked out connection is health checked and the checkout is retried with
+# exponential backoff, so a short MySQL outage does not fail every caller.
+# Closing a connection returns it to the pool.
+class MySQLPool:
+
+    def __init__(self, pool_name='gleamm_nire', pool_size=4, connection_timeout=10, retries=3, backoff=0.5, **config):
+        """
+        :param pool_name: name of the mysql.connector pool
+        :param pool_size: maximum number of open connections in this process
+        :param connection_timeout: seconds to wait for the MySQL server on connect
+        :param retries: how many times a failed checkout is retried
+        :param backoff: first retry delay in seconds, doubled on every retry
+        :param config: connection settings, defaults to DB_CONFIG
+        """
+        self._pool_name = pool_name
+        self._pool_size = pool_size
+        self._connection_timeout = connection_timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._config = config or DB_CONFIG
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        # Created lazily, so importing a dashboard does not need the database to be up
+        with self._lock:
+            if self._pool is None:
+                self._pool = pooling.MySQLConnectionPool(pool_name=self._pool_name,
+                                                         pool_size=self._pool_size,
+                                                         pool_reset_session=True,
+                                                         connection_timeout=self._connection_timeout,
+                                                         **self._config)
+            return self._pool
+
+    def get_connection(self):
+        """
+        Returns a healthy pooled connection. Call close() on it to hand it back.
+        """
+        for attempt in range(self._retries + 1):
+            connection = None
+            try:
+                connection = self._get_pool().get_connection()
+                connection.ping(reconnect=True, attempts=1, delay=0)
+                return connection
+            except mysql.connector.Error as e:
+                if connection is not None:
+                    connection.close()
+                if attempt == self._retries:
+                    raise
+                delay = self._backoff * 2 ** attempt
+                _log.warning("MySQL connection failed (%s), retrying in %s s", e, delay)
+                time.sleep(delay)
+
+
+db_pool = MySQLPool()
+
+
+# Database connection setup shared by the dashboards and the exporter
+def get_db_connection():
+    return db_pool.get_connection()
+
+
+# Historian topic_id of a topic name, None while nothing was stored on it
+def topic_id_of(connection, topic_name):
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT topic_id FROM GLEAMM_NIRE.topics WHERE topic_name = %s", (topic_name,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+    finally:
+        cursor.close()
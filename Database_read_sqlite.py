@@ -1,23 +1,19 @@
-import sqlite3
+from facadeAgent.device_config import DeviceConfigRepository
 
-# Step 1: Connect to the SQLite database (or create it if it doesn't exist)
-conn = sqlite3.connect('./FacadeAgent/Device_configure_database.sqlite')
+# Step 1: Open the device configuration (indexed devices table)
+devices = DeviceConfigRepository('./FacadeAgent/Device_configure_database.sqlite')
 
-# Step 2: Create a cursor object
-cursor = conn.cursor()
+# Step 2: Read every device as a typed DeviceConfig record
+configs = devices.load()
 
-# Step 3: Execute a SELECT query
-cursor.execute("SELECT * FROM devices")
+# Step 3: Work with the fetched data
+for config in configs.values():
+    print(config)
 
-# Step 4: Fetch the results
-rows = cursor.fetchall()  # To fetch all rows
-# rows = cursor.fetchone()  # To fetch the first row
-# rows = cursor.fetchmany(10)  # To fetch the first 10 rows
+# Indexed lookups
+# print(devices.by_building('building540'))
+# print(devices.by_controller('NIRE_WeMo_cc_1'))
+# print(devices.by_priority(1))
 
-# Step 5: Work with the fetched data
-for row in rows:
-    print(row)
-
-# Step 6: Close the cursor and connection
-cursor.close()
-conn.close()
\ No newline at end of file
+# Step 4: Close the connection
+devices.close()
@@ -1,5 +1,11 @@
+import argparse
+import csv
+import json
+import os
 import sqlite3
 
+DEVICE_COLUMNS = ['device_id', 'max_power_rating', 'controller_id', 'building_id', 'priority', 'power_multiply_factor']
+
 # Connect to the SQLite database
 conn = sqlite3.connect('./FacadeAgent/Device_configure_database.sqlite')
 
@@ -56,32 +62,103 @@ def update_device(device_id, max_power_rating=None, controller_id=None,building_
     conn.commit()
     print(f"Device {device_id} updated successfully.")
 
+# WAL journal (readers such as the Facade agent's reload do not block the writer)
+# and the indexes used to look devices up by building, controller and priority
+def prepare_database(connection=conn):
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE INDEX IF NOT EXISTS idx_devices_building_id ON devices (building_id)')
+    connection.execute('CREATE INDEX IF NOT EXISTS idx_devices_controller_id ON devices (controller_id)')
+    connection.execute('CREATE INDEX IF NOT EXISTS idx_devices_priority ON devices (priority)')
+    connection.commit()
+
+# Read a device manifest: a CSV file with a header row or a JSON list of objects,
+# both using the devices table column names
+def load_manifest(path):
+    with open(path, newline='') as manifest_file:
+        if os.path.splitext(path)[1].lower() == '.json':
+            records = json.load(manifest_file)
+        else:
+            records = list(csv.DictReader(manifest_file))
+    devices = []
+    for record in records:
+        devices.append((
+            record['device_id'],
+            float(record['max_power_rating']),
+            record.get('controller_id') or None,
+            record.get('building_id') or None,
+            int(record.get('priority') or 0),
+            float(record.get('power_multiply_factor') or 1),
+        ))
+    return devices
+
+# Upsert a whole manifest in a single transaction.
+# Returns the number of inserted, updated and unchanged devices.
+def provision_devices(devices, connection=conn):
+    existing = {row[0]: row for row in connection.execute(f"SELECT {', '.join(DEVICE_COLUMNS)} FROM devices")}
+    inserts = []
+    updates = []
+    unchanged = 0
+    for device in {device[0]: tuple(device) for device in devices}.values():
+        current = existing.get(device[0])
+        if current is None:
+            inserts.append(device)
+        elif current != device:
+            updates.append(device[1:] + device[:1])
+        else:
+            unchanged += 1
+
+    with connection:
+        connection.executemany(f'''
+            INSERT INTO devices ({', '.join(DEVICE_COLUMNS)})
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', inserts)
+        connection.executemany('''
+            UPDATE devices SET max_power_rating = ?, controller_id = ?, building_id = ?, priority = ?, power_multiply_factor = ?
+            WHERE device_id = ?
+        ''', updates)
+    return {'inserted': len(inserts), 'updated': len(updates), 'unchanged': unchanged}
+
 # Example usage:
-p=[1,2,1,1,3,2,2,2,1,1,3,1,1,1,3,3,3,2,2,1,1,3,1]
-for i in range(0,15):
-    insert_device('building540/NIRE_WeMo_cc_1/w'+str(i+1), 5.0, 'NIRE_WeMo_cc_1','building540',p[i],0.001)
+def insert_example_devices():
+    p=[1,2,1,1,3,2,2,2,1,1,3,1,1,1,3,3,3,2,2,1,1,3,1]
+    for i in range(0,15):
+        insert_device('building540/NIRE_WeMo_cc_1/w'+str(i+1), 5.0, 'NIRE_WeMo_cc_1','building540',p[i],0.001)
 
 
-for j in range(0,11):
-    print(j)
-    insert_device('building540/NIRE_WeMo_cc_4/w'+str(j+1), 5.0, 'NIRE_WeMo_cc_4','building540',p[j],0.001)
+    for j in range(0,11):
+        print(j)
+        insert_device('building540/NIRE_WeMo_cc_4/w'+str(j+1), 5.0, 'NIRE_WeMo_cc_4','building540',p[j],0.001)
 
     
-for j in range(0,14):
-    print(j)
-    insert_device('building540/NIRE_ALPHA_cc_2/w'+str(j+1), 5.0, 'NIRE_ALPHA_cc_2','building540',p[j],0.001)
+    for j in range(0,14):
+        print(j)
+        insert_device('building540/NIRE_ALPHA_cc_2/w'+str(j+1), 5.0, 'NIRE_ALPHA_cc_2','building540',p[j],0.001)
     
-insert_device('building540/NIRE_ALPHA_cc_1/w2', 5.0, 'NIRE_ALPHA_cc_1','building540',1)
-insert_device('building540/NIRE_ALPHA_cc_1/w3', 5.0, 'NIRE_ALPHA_cc_1','building540',1)
-insert_device('building540/NIRE_ALPHA_cc_1/w4', 5.0, 'NIRE_ALPHA_cc_1','building540',1)
-insert_device('building540/NIRE_ALPHA_cc_1/w6', 5.0, 'NIRE_ALPHA_cc_1','building540',2)
-insert_device('building540/NIRE_ALPHA_cc_1/w17', 5.0, 'NIRE_ALPHA_cc_1','building540',3)
-insert_device('building540/NIRE_ALPHA_cc_1/w19', 5.0, 'NIRE_ALPHA_cc_1','building540',3)
+    insert_device('building540/NIRE_ALPHA_cc_1/w2', 5.0, 'NIRE_ALPHA_cc_1','building540',1)
+    insert_device('building540/NIRE_ALPHA_cc_1/w3', 5.0, 'NIRE_ALPHA_cc_1','building540',1)
+    insert_device('building540/NIRE_ALPHA_cc_1/w4', 5.0, 'NIRE_ALPHA_cc_1','building540',1)
+    insert_device('building540/NIRE_ALPHA_cc_1/w6', 5.0, 'NIRE_ALPHA_cc_1','building540',2)
+    insert_device('building540/NIRE_ALPHA_cc_1/w17', 5.0, 'NIRE_ALPHA_cc_1','building540',3)
+    insert_device('building540/NIRE_ALPHA_cc_1/w19', 5.0, 'NIRE_ALPHA_cc_1','building540',3)
+
+
+    # update_device('w1', max_power_rating=175.0)
+    # update_device('w2', controller_id='Alpha_CC_1')
+    # update_device('w1', max_power_rating=180.0,building_id='GLEAMM')
+
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Provision the facade devices table')
+    parser.add_argument('--manifest', help='CSV or JSON device manifest to upsert in one transaction; '
+                                           'without it the example devices are inserted one by one')
+    args = parser.parse_args()
 
-# update_device('w1', max_power_rating=175.0)
-# update_device('w2', controller_id='Alpha_CC_1')
-# update_device('w1', max_power_rating=180.0,building_id='GLEAMM')
+    prepare_database()
+    if args.manifest:
+        counts = provision_devices(load_manifest(args.manifest))
+        print(f"{counts['inserted']} devices inserted, {counts['updated']} updated, {counts['unchanged']} unchanged.")
+    else:
+        insert_example_devices()
 
-# Close the connection
-conn.close()
+    # Close the connection
+    conn.close()
@@ -0,0 +1,70 @@
+import os
+import sqlite3
+import threading
+
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Device_configure_database.sqlite')
+
+
+# Registry of the facade devices, built from the devices table of
+# Device_configure_database.sqlite.
+#
+# Maps the full identifier (building540/<controller>/<w_key>) to a compact
+# integer id, so per-device series never merge on a shared w_key and
+# aggregations can run on int keys. Devices reporting in the snapshots but
+# missing from the table (e.g. the EV charger) are appended on first sight.
+# Ids are only stable within a process; persist the identifier, not the id.
+class DeviceRegistry:
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._identifiers = []
+        self._controllers = []
+        self._priorities = []
+        if db_path is not None and os.path.exists(db_path):
+            conn = sqlite3.connect(db_path)
+            try:
+                rows = conn.execute("SELECT device_id, controller_id, priority FROM devices ORDER BY rowid").fetchall()
+            finally:
+                conn.close()
+            for identifier, controller_id, priority in rows:
+                self._register(identifier, controller_id, priority)
+
+    def _register(self, identifier, controller_id=None, priority=None):
+        device_id = len(self._identifiers)
+        self._ids[identifier] = device_id
+        self._identifiers.append(identifier)
+        self._controllers.append(controller_id)
+        self._priorities.append(priority)
+        return device_id
+
+    def __len__(self):
+        return len(self._identifiers)
+
+    def id_of(self, identifier):
+        """
+        Returns the id of a device, registering unknown identifiers.
+        """
+        device_id = self._ids.get(identifier)
+        if device_id is None:
+            with self._lock:
+                device_id = self._ids.get(identifier)
+                if device_id is None:
+                    device_id = self._register(identifier)
+        return device_id
+
+    def identifier_of(self, device_id):
+        return self._identifiers[device_id]
+
+    def label_of(self, device_id):
+        """
+        Short display name: <controller>/<w_key>, the building is implied.
+        """
+        return '/'.join(self._identifiers[device_id].split('/')[-2:])
+
+    def identifiers(self):
+        return list(self._identifiers)
+
+    def labels(self):
+        return [self.label_of(device_id) for device_id in range(len(self._identifiers))]
@@ -0,0 +1,63 @@
+import numpy as np
+
+
+class GroupSeries:
+    """
+    Per-group power time series over the snapshots of a MonitorView.
+
+    keys:   group keys in ascending order (priorities or device indices)
+    values: 2D array [len(keys), snapshots], NaN where the group did not report
+    latest: last reported value of each group
+    total:  sum over all groups per snapshot, NaN where no group reported
+    """
+
+    def __init__(self, keys, values, latest, total):
+        self.keys = keys
+        self.values = values
+        self.latest = latest
+        self.total = total
+
+
+def snapshot_index(view):
+    """
+    Returns, for every row of the view, the index of the snapshot it belongs to.
+    """
+    counts = np.diff(np.append(view.snapshot_offset, len(view.ts)))
+    return np.repeat(np.arange(len(view.snapshot_ts)), counts)
+
+
+# One pass aggregation of the power column by priority or by device.
+#
+# Instead of a groupby followed by a boolean mask per group (samples x groups),
+# rows are mapped to a dense (group, snapshot) cell and summed with a single
+# np.bincount, so the cost is linear in the number of samples.
+def aggregate_power(view, by='priority', mask=None):
+    """
+    :param view: MonitorView to aggregate
+    :param by: row column to group on, 'priority' or 'device'
+    :param mask: optional boolean array selecting the rows to include
+    :returns: GroupSeries
+    """
+    n_snapshots = len(view.snapshot_ts)
+    snapshots = snapshot_index(view)
+    groups = getattr(view, by)
+    power = view.power
+    if mask is not None:
+        snapshots = snapshots[mask]
+        groups = groups[mask]
+        power = power[mask]
+
+    keys, group_index = np.unique(groups, return_inverse=True)
+    cells = group_index.astype(np.int64) * n_snapshots + snapshots
+    size = len(keys) * n_snapshots
+    sums = np.bincount(cells, weights=np.nan_to_num(power), minlength=size).reshape(len(keys), n_snapshots)
+    present = np.bincount(cells, minlength=size).reshape(len(keys), n_snapshots) > 0
+
+    values = np.where(present, sums, np.nan)
+    total = np.where(present.any(axis=0), sums.sum(axis=0), np.nan)
+    if n_snapshots:
+        last_present = n_snapshots - 1 - np.argmax(present[:, ::-1], axis=1)
+        latest = values[np.arange(len(keys)), last_present]
+    else:
+        latest = np.empty(0)
+    return GroupSeries(keys, values, latest, total)
@@ -0,0 +1,210 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from Database_pool import topic_id_of
+from Telemetry_compact import COMPACT_TOPIC
+
+_log = logging.getLogger(__name__)
+
+
+# Shared, process-wide cache of the facade snapshots stored by the Facade
+# agent, its compact payload (COMPACT_TOPIC, see Telemetry_compact.py).
+#
+# Every dashboard callback used to pull the full time window and json.loads
+# every row. The cache keeps the window in memory, asks MySQL only for rows
+# newer than the last ts it has seen and evicts rows that fall out of the
+# window, so N viewers cost one incremental query per refresh interval.
+#
+# The incremental query includes the last seen ts itself: rows sharing it
+# may be committed after the previous fetch. The rows already cached at
+# that ts are recognised by their value and skipped.
+#
+# The agent spools its publishes while the store is unreachable and replays
+# them later, older than the rows cached since. Every fill_interval the
+# cycles missing from the window are looked up again, the window is then
+# rebuilt in ts order and the rollup buckets of the filled cycles are
+# recomputed.
+class TelemetryCache:
+
+    def __init__(self, connection_factory, topic=COMPACT_TOPIC, window=timedelta(hours=3), refresh_interval=20, store=None,
+                 rollup=None, fill_gap=timedelta(seconds=100), fill_interval=300, layout_lookback=timedelta(minutes=11)):
+        """
+        :param connection_factory: callable returning a DB-API connection to GLEAMM_NIRE
+        :param topic: historian topic name of the compact payload
+        :param window: how much history is kept in memory
+        :param refresh_interval: minimum seconds between two queries to MySQL
+        :param store: optional MonitorStore, fed with every new snapshot exactly once
+        :param rollup: optional PowerRollup, updated from the store after every refresh that brought new rows
+        :param fill_gap: snapshots further apart than this leave cycles to fill
+        :param fill_interval: minimum seconds between two lookups of the missing cycles
+        :param layout_lookback: how far before the window or a gap the layout message of its snapshots is looked up
+                                (the agent repeats it every 10 minutes)
+        """
+        self._connection_factory = connection_factory
+        self._topic = topic
+        self._topic_id = None  # resolved on first use
+        self._window = window
+        self._refresh_interval = refresh_interval
+        self._store = store
+        self._rollup = rollup
+        self._rows = deque()  # (ts, data) in ascending ts order
+        self._last_ts = None
+        self._last_ts_values = set()  # value_string of the cached rows at _last_ts
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False  # a query to MySQL is in flight
+        self._fill_gap = fill_gap
+        self._fill_interval = fill_interval
+        self._layout_lookback = layout_lookback
+        self._last_fill = None
+
+    def _fetch(self, query, params):
+        connection = self._connection_factory()
+        try:
+            if self._topic_id is None:
+                self._topic_id = topic_id_of(connection, self._topic)
+                if self._topic_id is None:
+                    return []  # nothing published on the topic yet
+            cursor = connection.cursor()
+            try:
+                cursor.execute(query, (self._topic_id,) + params)
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+        finally:
+            connection.close()
+
+    def _fetch_new_rows(self, since):
+        query = """ SELECT ts, value_string FROM GLEAMM_NIRE.data where topic_id=%s and ts <= UTC_TIMESTAMP() and ts >= %s ORDER BY ts ASC """
+        if since is None:
+            # From the last layout message the first snapshots of the window need
+            return self._fetch(query, (datetime.utcnow() - self._window - self._layout_lookback,))
+        return self._fetch(query, (since,))
+
+    def _fetch_fill_rows(self, start, end):
+        query = """ SELECT ts, value_string FROM GLEAMM_NIRE.data where topic_id=%s and ts > %s and ts < %s ORDER BY ts ASC """
+        return self._fetch(query, (start, end))
+
+    def _gaps(self):
+        # (previous ts, next ts) of the cached snapshots further apart than fill_gap
+        gaps = []
+        previous = None
+        for ts, data in self._rows:
+            if 'devices' in data:
+                continue  # layout message
+            if previous is not None and ts - previous > self._fill_gap:
+                gaps.append((previous, ts))
+            previous = ts
+        return gaps
+
+    def _fill(self, gaps):
+        """
+        Snapshots of the cycles missing in gaps, with the layout messages they need,
+        as (ts, data) in ascending ts order.
+        """
+        layouts = {}  # layout id -> (ts, data) of its last layout message
+        filled = {}  # (ts, is snapshot) -> (ts, data), a layout message may share the ts of its first snapshot
+        for ts, value_string in self._fetch_fill_rows(gaps[0][0] - self._layout_lookback, gaps[-1][1]):
+            data = json.loads(value_string)
+            if 'devices' in data:
+                layouts[data.get('layout')] = (ts, data)
+            elif any(start < ts < end for start, end in gaps):
+                layout = layouts.get(data.get('layout'))
+                if layout is not None:
+                    filled[(layout[0], False)] = layout
+                filled[(ts, True)] = (ts, data)
+        return [filled[key] for key in sorted(filled)]
+
+    def _evict(self):
+        oldest_allowed = datetime.utcnow() - self._window
+        while self._rows and self._rows[0][0] < oldest_allowed:
+            self._rows.popleft()
+        if self._store is not None:
+            self._store.evict_before(oldest_allowed)
+
+    def refresh(self, force=False):
+        """
+        Pull the rows newer than the last cached ts and drop the expired ones.
+        Returns the number of new snapshots added to the cache.
+
+        MySQL is queried outside the lock, by one caller at a time: the other
+        callers, and every caller while MySQL is unreachable, are served the
+        cached window instead of queueing behind the connection retries.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._refreshing or (not force and self._rows and now - self._last_refresh < self._refresh_interval):
+                return 0
+            self._refreshing = True
+            since = self._last_ts
+
+        try:
+            fetched = self._fetch_new_rows(since)
+        except Exception:
+            _log.exception("Fetching the facade snapshots failed, serving the cached window")
+            with self._lock:
+                self._refreshing = False
+                self._last_refresh = now
+            return 0
+
+        with self._lock:
+            rows = [(ts, value_string) for ts, value_string in fetched
+                    if not (ts == self._last_ts and value_string in self._last_ts_values)]
+            for ts, value_string in rows:
+                data = json.loads(value_string)
+                self._rows.append((ts, data))
+                if self._store is not None:
+                    self._store.append(ts, data)
+            if rows:
+                if rows[-1][0] != self._last_ts:
+                    self._last_ts = rows[-1][0]
+                    self._last_ts_values = set()
+                self._last_ts_values.update(value_string for ts, value_string in rows if ts == self._last_ts)
+            fill_due = self._last_fill is None or now - self._last_fill >= self._fill_interval
+            gaps = self._gaps() if fill_due else []
+
+        filled = []
+        if gaps:
+            try:
+                filled = self._fill(gaps)
+            except Exception:
+                _log.exception("Filling the missing facade snapshots failed")
+
+        with self._lock:
+            self._refreshing = False
+            if fill_due:
+                self._last_fill = now
+            cached = {(ts, 'devices' not in data) for ts, data in self._rows}
+            filled = [(ts, data) for ts, data in filled if (ts, 'devices' not in data) not in cached]
+            if filled:
+                self._rows = deque(sorted(list(self._rows) + filled, key=lambda row: row[0]))
+                if self._store is not None:
+                    self._store.clear()
+                    for ts, data in self._rows:
+                        self._store.append(ts, data)
+            self._last_refresh = now
+            self._evict()
+            if (rows or filled) and self._rollup is not None:
+                self._rollup.update(self._store.view(), since=filled[0][0] if filled else None)
+            return len(rows) + sum('devices' not in data for ts, data in filled)
+
+    def get_data_list(self):
+        """
+        Returns the cached window as [(ts, data), ...] ordered newest first,
+        the same shape the dashboard callbacks used to build from fetchall().
+        The snapshot dicts are shared between callers and must not be mutated.
+        """
+        self.refresh()
+        with self._lock:
+            return list(reversed(self._rows))
+
+    def get_view(self):
+        """
+        Refreshes the cache and returns a MonitorView of the attached store.
+        """
+        self.refresh()
+        return self._store.view()
@@ -0,0 +1,115 @@
+from collections import deque, namedtuple
+from datetime import timedelta
+
+from facadeAgent.compact import COMPACT_TOPIC, SCHEMA_VERSION
+
+
+# Compact facade payload, published by the Facade agent (facadeAgent/compact.py)
+# on COMPACT_TOPIC every publish cycle. It is the primary stored format, the
+# nested Monitor JSON (topic_id=5) is only stored on control commands and every
+# few minutes; the readers fall back to it for the history older than the
+# compact topic.
+#
+# Layout message, on start, when the device table changes and periodically
+# so a reader joining late finds it:
+#   {'schema': 1, 'layout': <id>, 'devices': [[identifier, priority, maxpower], ...]}
+# Snapshot message, every publish cycle, one entry per layout device:
+#   {'schema': 1, 'layout': <id>, 'power': [...], 'status': [...], 'command': [...],
+#    'cmd': <control command>, 'LMP': <LMP, when the agent has one>,
+#    'ev': {'power', 'energy', 'status', 'voltage', 'current', 'frequency', 'temperature'}}
+#
+# The static device metadata is only sent with the layout, a snapshot carries
+# the dense power / status arrays in layout order.
+
+Snapshot = namedtuple('Snapshot', ['identifiers', 'power', 'status', 'priority', 'maxpower', 'command', 'lmp', 'cmd', 'ev'])
+Snapshot.__doc__ = """
+One decoded facade snapshot. identifiers, power, status, priority, maxpower and
+command are parallel sequences, one entry per device (None when not reported).
+lmp and cmd are the LMP and the Control/Django/cmd entry, ev the EV charger metrics.
+"""
+
+
+# Decoder of the facade snapshots stored in the historian, shared by the
+# dashboards (MonitorStore) and the history exporter (Data_base_react.py).
+#
+# Reads both the nested Monitor JSON and the compact payload. Layout messages
+# are remembered, compact snapshots of an unknown layout are skipped.
+class SnapshotDecoder:
+
+    def __init__(self):
+        self._layouts = {}  # layout id -> (identifiers, priority, maxpower)
+
+    def decode(self, data):
+        """
+        Returns the Snapshot of a stored payload, None for layout messages and
+        snapshots whose layout has not been seen yet.
+        """
+        if 'schema' not in data:
+            return _decode_nested(data)
+        if data['schema'] != SCHEMA_VERSION:
+            raise ValueError(f"Unsupported compact payload schema {data['schema']}")
+        if 'devices' in data:
+            identifiers, priority, maxpower = zip(*data['devices']) if data['devices'] else ((), (), ())
+            self._layouts[data['layout']] = (identifiers, priority, maxpower)
+            return None
+        layout = self._layouts.get(data['layout'])
+        if layout is None:
+            return None
+        identifiers, priority, maxpower = layout
+        return Snapshot(identifiers, data['power'], data['status'], priority, maxpower,
+                        data.get('command') or (None,) * len(identifiers), data.get('LMP'), data.get('cmd'),
+                        data.get('ev'))
+
+
+def _decode_nested(data):
+    identifiers, power, status, priority, maxpower, command = [], [], [], [], [], []
+    ev = None
+    for building, controllers in data.get('Monitor', {}).items():
+        if building == 'EV':
+            # Older layout: Monitor -> EV -> device -> metrics
+            controllers = {'EV': controllers}
+        for controller, devices in controllers.items():
+            for device, metrics in devices.items():
+                # The EV charger is keyed by its full identifier already
+                identifiers.append(device if controller == 'EV' else f"{building}/{controller}/{device}")
+                power.append(metrics.get('power'))
+                status.append(metrics.get('status'))
+                priority.append(metrics.get('priority'))
+                maxpower.append(metrics.get('maxpower'))
+                command.append(metrics.get('command'))
+                if controller == 'EV':
+                    ev = metrics
+    return Snapshot(identifiers, power, status, priority, maxpower, command,
+                    data.get('LMP'), data.get('Control', {}).get('Django', {}).get('cmd', None), ev)
+
+
+# A nested snapshot and the compact payload of the same publish cycle are
+# stored a few seconds apart, the agent publishes a cycle every 40 s.
+SAME_CYCLE = timedelta(seconds=20)
+
+
+# Merge of the compact payload, the primary stream, and of the nested
+# snapshots. The agent stores the nested snapshot only on control commands and
+# every few minutes, the older history holds nothing else.
+#
+# rows are (ts, topic_id, data) of both topics in ascending ts order. Every
+# primary message is kept, a fill snapshot only when no primary snapshot is
+# within same_cycle of it. Layout messages are always kept, the decoder needs
+# them. Yields (ts, topic_id, data) in ascending ts order.
+def merge_snapshots(rows, fill_topic_id, same_cycle=SAME_CYCLE):
+    pending = deque()  # fill messages that a later primary snapshot may still cover
+    last_primary = None
+    for ts, topic_id, data in rows:
+        while pending and pending[0][0] < ts - same_cycle:
+            yield pending.popleft()
+        if topic_id != fill_topic_id and 'devices' not in data:
+            # What is left in pending is within same_cycle before this snapshot
+            while pending:
+                entry = pending.popleft()
+                if 'devices' in entry[2]:
+                    yield entry
+            last_primary = ts
+            yield ts, topic_id, data
+        elif 'devices' in data or last_primary is None or ts - last_primary > same_cycle:
+            pending.append((ts, topic_id, data))
+    yield from pending
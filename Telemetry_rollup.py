@@ -0,0 +1,192 @@
+import json
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from Telemetry_aggregate import aggregate_power
+from Telemetry_compact import merge_snapshots
+from Telemetry_store import MonitorStore, MISSING
+
+
+RAW_INTERVAL = 40  # seconds between two facade snapshots
+RESOLUTIONS = [60, 900, 3600]  # 1 min / 15 min / 1 h buckets, in seconds
+MAX_POINTS = 500  # upper bound of points per trace sent to the browser
+
+
+def pick_resolution(span, max_points=MAX_POINTS):
+    """
+    Returns the bucket size (seconds) to display a time span with at most
+    max_points points, or None when the raw 40 s snapshots fit.
+    """
+    seconds = span.total_seconds()
+    if seconds / RAW_INTERVAL <= max_points:
+        return None
+    for resolution in RESOLUTIONS:
+        if seconds / resolution <= max_points:
+            return resolution
+    return RESOLUTIONS[-1]
+
+
+# Multi-resolution min/mean/max power rollups per device, per priority and
+# for the whole facade, kept in a small SQLite file next to the dashboard.
+#
+# Buckets touched by new snapshots are recomputed from the in-memory window
+# and written with INSERT OR REPLACE, so every gunicorn worker can run the
+# same rollup without double counting. The in-memory window must be at least
+# as long as the largest bucket.
+class PowerRollup:
+
+    def __init__(self, path='Power_rollup.sqlite'):
+        self._path = path
+        self._lock = threading.Lock()
+        self._last_ts = None
+        with closing(self._connect()) as connection, connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS power_rollup (
+                    resolution INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    min_power REAL,
+                    mean_power REAL,
+                    max_power REAL,
+                    samples INTEGER,
+                    PRIMARY KEY (resolution, kind, key, bucket)
+                ) WITHOUT ROWID
+            ''')
+
+    def _connect(self):
+        return sqlite3.connect(self._path, timeout=10)
+
+    def update(self, view, since=None):
+        """
+        Recompute and store every bucket touched by snapshots newer than the last update,
+        and by the snapshots at or after since (older snapshots filled in since the last update).
+        """
+        with self._lock:
+            if not len(view):
+                return
+            snapshot_seconds = view.snapshot_ts.astype('datetime64[s]').astype(np.int64)
+            if self._last_ts is None:
+                first_new = snapshot_seconds[0]
+            else:
+                newer = snapshot_seconds > self._last_ts
+                if since is not None:
+                    newer |= snapshot_seconds >= np.datetime64(since, 's').astype(np.int64)
+                if not newer.any():
+                    return
+                first_new = snapshot_seconds[newer][0]
+
+            by_device = aggregate_power(view, by='device')
+            by_priority = aggregate_power(view, by='priority', mask=view.priority != MISSING)
+            series = [('device', [view.device_ids[device] for device in by_device.keys], by_device.values),
+                      ('priority', [str(priority) for priority in by_priority.keys], by_priority.values),
+                      ('total', ['total'], by_device.total[np.newaxis, :])]
+
+            # A bucket that started before the window is only partially known, leave it as stored
+            window_start = snapshot_seconds[0] - RAW_INTERVAL
+            records = []
+            for resolution in RESOLUTIONS:
+                buckets = snapshot_seconds // resolution * resolution
+                touched = (buckets >= first_new // resolution * resolution) & (buckets > window_start)
+                for bucket in np.unique(buckets[touched]):
+                    columns = buckets == bucket
+                    for kind, keys, values in series:
+                        records.extend(_bucket_records(resolution, kind, keys, int(bucket), values[:, columns]))
+
+            with closing(self._connect()) as connection, connection:
+                connection.executemany('INSERT OR REPLACE INTO power_rollup VALUES (?, ?, ?, ?, ?, ?, ?, ?)', records)
+            self._last_ts = max(snapshot_seconds[-1], self._last_ts or snapshot_seconds[-1])
+
+    def read(self, kind, start, end, resolution):
+        """
+        Returns {key: (bucket_ts, min, mean, max)} for the buckets of a resolution in [start, end).
+        """
+        with closing(self._connect()) as connection:
+            rows = connection.execute('''
+                SELECT key, bucket, min_power, mean_power, max_power FROM power_rollup
+                WHERE resolution = ? AND kind = ? AND bucket >= ? AND bucket < ?
+                ORDER BY key, bucket
+            ''', (resolution, kind, _epoch(start), _epoch(end))).fetchall()
+
+        series = {}
+        for key, bucket, min_power, mean_power, max_power in rows:
+            series.setdefault(key, []).append((bucket, min_power, mean_power, max_power))
+        for key, points in series.items():
+            bucket, min_power, mean_power, max_power = (np.array(column) for column in zip(*points))
+            series[key] = (bucket.astype('datetime64[s]'), min_power, mean_power, max_power)
+        return series
+
+
+def _bucket_records(resolution, kind, keys, bucket, values):
+    samples = (~np.isnan(values)).sum(axis=1)
+    reported = samples > 0
+    if not reported.any():
+        return []
+    values = values[reported]
+    minimum = np.nanmin(values, axis=1)
+    mean = np.nanmean(values, axis=1)
+    maximum = np.nanmax(values, axis=1)
+    keys = [key for key, ok in zip(keys, reported) if ok]
+    return [(resolution, kind, key, bucket, float(lo), float(avg), float(hi), int(count))
+            for key, lo, avg, hi, count in zip(keys, minimum, mean, maximum, samples[reported])]
+
+
+def _epoch(ts):
+    return int((ts - datetime(1970, 1, 1)).total_seconds())
+
+
+def backfill(connection_factory, start, end, rollup, topic_id, fill_topic_id=5, layout_lookback=timedelta(minutes=11)):
+    """
+    Fill the rollups from the historian one hour at a time, so each chunk
+    covers whole buckets of every resolution. topic_id is the compact payload,
+    the cycles missing from it are taken from the nested snapshots of fill_topic_id.
+    """
+    chunk_start = datetime(start.year, start.month, start.day, start.hour)
+    while chunk_start < end:
+        chunk_end = chunk_start + timedelta(seconds=RESOLUTIONS[-1])
+        connection = connection_factory()
+        cursor = connection.cursor()
+        try:
+            # From before the chunk: the compact snapshots need the last layout message,
+            # and the merge the snapshots of both topics next to the chunk start
+            cursor.execute(""" SELECT ts, topic_id, value_string FROM GLEAMM_NIRE.data where topic_id in (%s, %s) and ts >= %s and ts < %s ORDER BY ts ASC """,
+                           (topic_id, fill_topic_id, chunk_start - layout_lookback, chunk_end))
+            store = MonitorStore()
+            for ts, row_topic_id, data in merge_snapshots(((ts, row_topic_id, json.loads(value_string))
+                                                           for ts, row_topic_id, value_string in cursor), fill_topic_id):
+                # Layout messages are remembered, the snapshots before the chunk belong to the previous one
+                if ts >= chunk_start or 'devices' in data:
+                    store.append(ts, data)
+        finally:
+            cursor.close()
+            connection.close()
+        rollup.update(store.view())
+        print(f"Rollups updated for {chunk_start} - {chunk_end}")
+        chunk_start = chunk_end
+
+
+if __name__ == '__main__':
+    import argparse
+    from Database_pool import get_db_connection, topic_id_of
+    from Telemetry_compact import COMPACT_TOPIC
+
+    parser = argparse.ArgumentParser(description='Backfill the dashboard power rollups from the historian')
+    parser.add_argument('--days', type=int, default=7, help='how many days of history to roll up')
+    args = parser.parse_args()
+
+    now = datetime.utcnow()
+    connection = get_db_connection()
+    try:
+        compact_topic_id = topic_id_of(connection, COMPACT_TOPIC)
+    finally:
+        connection.close()
+    if compact_topic_id is None:
+        # Nothing published on the compact topic yet, the nested snapshots are all there is
+        backfill(get_db_connection, now - timedelta(days=args.days), now, PowerRollup(), topic_id=5, fill_topic_id=None)
+    else:
+        backfill(get_db_connection, now - timedelta(days=args.days), now, PowerRollup(), topic_id=compact_topic_id)
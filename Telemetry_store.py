@@ -0,0 +1,203 @@
+import threading
+
+import numpy as np
+
+from Device_registry import DeviceRegistry
+from Telemetry_compact import SnapshotDecoder
+
+
+MISSING = -1  # priority / status value used when a snapshot does not report it
+
+_ROW_COLUMNS = {
+    'ts': 'datetime64[us]',
+    'device': np.int32,
+    'priority': np.int16,
+    'power': np.float64,
+    'status': np.int16,
+    'maxpower': np.float64,
+}
+
+
+class MonitorView:
+    """
+    Read-only slice of a MonitorStore.
+
+    Row columns (one entry per device per snapshot, ascending ts):
+    ts, device, priority, power, status, maxpower.
+    Snapshot columns (one entry per snapshot, ascending ts):
+    snapshot_ts, snapshot_offset (first row of the snapshot), lmp, commands, ev.
+    generation changes every time the store is rebuilt from scratch.
+    """
+
+    def __init__(self, rows, snapshot_ts, snapshot_offset, lmp, commands, ev, device_ids, device_labels, generation=0):
+        self.ts = rows['ts']
+        self.device = rows['device']
+        self.priority = rows['priority']
+        self.power = rows['power']
+        self.status = rows['status']
+        self.maxpower = rows['maxpower']
+        self.snapshot_ts = snapshot_ts
+        self.snapshot_offset = snapshot_offset
+        self.lmp = lmp
+        self.commands = commands
+        self.ev = ev
+        self.device_ids = device_ids
+        self.device_labels = device_labels
+        self.generation = generation
+
+    def __len__(self):
+        return len(self.snapshot_ts)
+
+    def latest_rows(self):
+        """
+        Slice object selecting the rows of the newest snapshot.
+        """
+        if not len(self.snapshot_ts):
+            return slice(0, 0)
+        return slice(int(self.snapshot_offset[-1]), len(self.ts))
+
+
+# Columnar in-memory store of the Monitor part of the facade snapshots.
+#
+# Each snapshot is flattened exactly once, when it arrives, from the nested
+# Monitor -> building -> controller -> device -> metrics dicts (or the compact
+# payload, see Telemetry_compact.py) into NumPy columns. Callbacks slice the
+# columns instead of walking the dicts again.
+class MonitorStore:
+
+    def __init__(self, capacity=8192, registry=None):
+        self._lock = threading.Lock()
+        self._registry = registry if registry is not None else DeviceRegistry()
+        self._decoder = SnapshotDecoder()
+        self._layout = None  # identifiers of the last compact layout, and their ids
+        self._layout_ids = None
+        self._rows = {name: np.empty(capacity, dtype=dtype) for name, dtype in _ROW_COLUMNS.items()}
+        self._start = 0
+        self._end = 0
+        self._snapshot_ts = []
+        self._snapshot_offset = []  # absolute row offset, rebased on compaction
+        self._lmp = []
+        self._commands = []
+        self._ev = []
+        self._generation = 0  # incremented by clear()
+
+    def device_index(self, identifier):
+        """
+        Returns the compact integer id of a device in the registry.
+        """
+        return self._registry.id_of(identifier)
+
+    def _reserve(self, count):
+        capacity = len(self._rows['ts'])
+        if self._end + count <= capacity:
+            return
+        live = self._end - self._start
+        new_capacity = capacity
+        while live + count > new_capacity // 2:
+            new_capacity *= 2
+        # New buffers, so views handed out earlier stay valid
+        for name, column in self._rows.items():
+            new_column = np.empty(new_capacity, dtype=column.dtype)
+            new_column[:live] = column[self._start:self._end]
+            self._rows[name] = new_column
+        self._snapshot_offset = [offset - self._start for offset in self._snapshot_offset]
+        self._start = 0
+        self._end = live
+
+    def _device_ids(self, identifiers):
+        # Compact snapshots share the identifiers of their layout, resolved once
+        if identifiers is self._layout:
+            return self._layout_ids
+        ids = np.fromiter((self.device_index(identifier) for identifier in identifiers), dtype=np.int32, count=len(identifiers))
+        if isinstance(identifiers, tuple):
+            self._layout, self._layout_ids = identifiers, ids
+        return ids
+
+    def append(self, ts, data):
+        """
+        Flatten one facade snapshot into the store. Snapshots must arrive in ascending ts order.
+        Layout messages of the compact payload are only remembered.
+        """
+        snapshot = self._decoder.decode(data)
+        if snapshot is None:
+            return
+
+        with self._lock:
+            count = len(snapshot.identifiers)
+            self._reserve(count)
+            offset = self._end
+            end = offset + count
+            rows = self._rows
+            rows['ts'][offset:end] = np.datetime64(ts, 'us')
+            rows['device'][offset:end] = self._device_ids(snapshot.identifiers)
+            rows['priority'][offset:end] = _ints_or_missing(snapshot.priority)
+            rows['power'][offset:end] = _floats_or_nan(snapshot.power)
+            rows['status'][offset:end] = _ints_or_missing(snapshot.status)
+            rows['maxpower'][offset:end] = _floats_or_nan(snapshot.maxpower)
+            self._end = end
+            self._snapshot_ts.append(ts)
+            self._snapshot_offset.append(offset)
+            self._lmp.append(snapshot.lmp)
+            self._commands.append(snapshot.cmd)
+            self._ev.append(snapshot.ev)
+
+    def evict_before(self, ts):
+        """
+        Drop every snapshot older than ts.
+        """
+        with self._lock:
+            count = 0
+            while count < len(self._snapshot_ts) and self._snapshot_ts[count] < ts:
+                count += 1
+            if not count:
+                return
+            self._start = self._snapshot_offset[count] if count < len(self._snapshot_ts) else self._end
+            del self._snapshot_ts[:count]
+            del self._snapshot_offset[:count]
+            del self._lmp[:count]
+            del self._commands[:count]
+            del self._ev[:count]
+
+    def clear(self):
+        """
+        Drop every snapshot, to append the window again when older snapshots were filled in.
+        The known layouts and device ids are kept, the views handed out afterwards
+        carry a new generation.
+        """
+        with self._lock:
+            self._generation += 1
+            # New buffers, so views handed out earlier stay valid
+            self._rows = {name: np.empty(len(column), dtype=column.dtype) for name, column in self._rows.items()}
+            self._start = 0
+            self._end = 0
+            self._snapshot_ts = []
+            self._snapshot_offset = []
+            self._lmp = []
+            self._commands = []
+            self._ev = []
+
+    def view(self):
+        """
+        Returns a MonitorView over the live window.
+        """
+        with self._lock:
+            rows = {name: column[self._start:self._end] for name, column in self._rows.items()}
+            offsets = np.asarray(self._snapshot_offset, dtype=np.int64) - self._start
+            return MonitorView(rows,
+                               np.array(self._snapshot_ts, dtype='datetime64[us]'),
+                               offsets,
+                               np.array([np.nan if lmp is None else lmp for lmp in self._lmp], dtype=np.float64),
+                               list(self._commands),
+                               list(self._ev),
+                               self._registry.identifiers(),
+                               self._registry.labels(),
+                               self._generation)
+
+
+def _ints_or_missing(values):
+    return [MISSING if value is None else int(value) for value in values]
+
+
+def _floats_or_nan(values):
+    # None converts to NaN with a float dtype
+    return np.array(values, dtype=np.float64)
@@ -0,0 +1,97 @@
+import threading
+
+import numpy as np
+
+
+def parse_command(command):
+    """
+    Returns the thresholds set by a Control/Django/cmd entry, None if it sets none.
+
+    {'1': ['simplecontrol', 300], ...} sets a threshold per priority group and
+    their sum as the total, ['lpc', 3000] sets the total threshold only.
+    """
+    if isinstance(command, dict):
+        priority_thresholds = {priority: cmd[1] for priority, cmd in command.items()}
+        return priority_thresholds, sum(priority_thresholds.values())
+    if isinstance(command, list) and len(command) == 2:
+        return {}, command[1]
+    return None
+
+
+# Threshold timeline of the control commands, aligned with the snapshots of a MonitorView.
+#
+# Every command is parsed once, when its snapshot first shows up, and the
+# active thresholds are carried forward in time with a vectorized forward-fill
+# (np.maximum.accumulate over the command positions). Results are kept between
+# refreshes: an update only processes the snapshots added since the last one
+# and drops the ones evicted from the window. When the store was rebuilt (older
+# snapshots filled in, see MonitorStore.clear) the timeline is built again.
+class ThresholdTimeline:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ts = np.empty(0, dtype='datetime64[us]')
+        self._total = np.empty(0)
+        self._priority = {}  # priority -> filled thresholds
+        self._current = None  # last command seen, as returned by parse_command
+        self._generation = None  # store generation of the snapshots in _ts
+
+    def update(self, view):
+        """
+        :returns: (total thresholds, {priority: thresholds}, current command), arrays aligned with view.snapshot_ts
+        """
+        with self._lock:
+            snapshot_ts = view.snapshot_ts
+            if view.generation != self._generation:
+                self._ts = np.empty(0, dtype='datetime64[us]')
+                self._total = np.empty(0)
+                self._priority = {}
+                self._current = None
+                self._generation = view.generation
+            if not len(snapshot_ts):
+                return np.empty(0), {}, None
+
+            # Drop snapshots evicted from the window
+            first = np.searchsorted(self._ts, snapshot_ts[0])
+            if first:
+                self._ts = self._ts[first:]
+                self._total = self._total[first:]
+                self._priority = {priority: values[first:] for priority, values in self._priority.items()}
+
+            start = np.searchsorted(snapshot_ts, self._ts[-1], side='right') if len(self._ts) else 0
+            if start < len(snapshot_ts):
+                self._extend(snapshot_ts[start:], view.commands[start:])
+            return self._total, self._priority, self._current
+
+    def _extend(self, snapshot_ts, commands):
+        count = len(commands)
+        parsed = [parse_command(command) for command in commands]
+        positions = [i + 1 for i, thresholds in enumerate(parsed) if thresholds is not None]
+
+        # Column 0 carries the state left by the previous update
+        priorities = set(self._priority)
+        for i in positions:
+            priorities.update(parsed[i - 1][0])
+        total = np.full(count + 1, np.nan)
+        total[0] = self._total[-1] if len(self._total) else np.nan
+        matrix = {priority: np.full(count + 1, np.nan) for priority in priorities}
+        for priority, values in self._priority.items():
+            matrix[priority][0] = values[-1] if len(values) else np.nan
+        for i in positions:
+            priority_thresholds, total[i] = parsed[i - 1]
+            for priority, threshold in priority_thresholds.items():
+                matrix[priority][i] = threshold
+
+        is_command = np.zeros(count + 1, dtype=bool)
+        is_command[0] = True
+        is_command[positions] = True
+        last_command = np.maximum.accumulate(np.where(is_command, np.arange(count + 1), 0))[1:]
+
+        previous = len(self._ts)
+        self._ts = np.concatenate([self._ts, snapshot_ts])
+        self._total = np.concatenate([self._total, total[last_command]])
+        for priority in priorities:
+            known = self._priority.get(priority, np.full(previous, np.nan))
+            self._priority[priority] = np.concatenate([known, matrix[priority][last_command]])
+        if positions:
+            self._current = parsed[positions[-1] - 1]
@@ -0,0 +1,204 @@
+"""
+Batched dispatch of the device set points.
+
+The plugs and the EV charger actuate through the VIP object they are built
+with, one blocking ``set_point`` round trip each. They are given an
+:class:`ActuatorProxy` instead. While a strategy runs inside
+:meth:`CommandBatcher.collecting`, the proxy records the ``set_point`` calls
+and answers them at once. When the strategy returns, the batch is flushed:
+- Repeated commands to the same point keep the last value.
+- Commands that would not change the device state are suppressed.
+- The rest are sent concurrently, at most ``concurrency`` at a time.
+Every other call goes straight to the real VIP object.
+
+The batcher remembers the last value successfully commanded on every point.
+A command is a real transition when it differs from the observed device
+state. Within ``settle`` seconds of the last command, and when the state is
+not observed (e.g. the EV charger), it is a real transition when it differs
+from the last commanded value, so reversing a recent command is sent. A
+device that drifted from its last command, through a manual switch or a
+lost command, is therefore commanded again, once ``settle`` seconds have
+left it time to report the command.
+
+The answers given while collecting are provisional: a device sees its
+command accepted before it is sent. The agent serializes the strategy runs,
+so only one batch is collected at a time. When a command of the batch
+fails, the agent runs the strategy again, which then reads the device state
+reported since and re-commands it.
+"""
+
+__docformat__ = 'reStructuredText'
+
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import gevent
+from gevent.event import AsyncResult
+from gevent.pool import Pool
+
+SET_POINT = 'set_point'
+
+
+class CommandBatcher(object):
+    """
+    :param vip: the agent VIP object used to send the commands
+    :param state_of: callable returning the observed value of a point topic, None when unknown
+    :param concurrency: maximum number of set_point calls in flight
+    :param timeout: seconds to wait for one set_point answer
+    :param settle: seconds a sent value is trusted before the observed state must reflect it
+    """
+
+    def __init__(self, vip, state_of=None, concurrency=8, timeout=10, settle=60):
+        self._vip = vip
+        self._state_of = state_of or (lambda topic: None)
+        self._concurrency = concurrency
+        self._timeout = timeout
+        self._settle = settle
+        self._batch = None  # (peer, topic) -> (args, kwargs) while collecting
+        self._collected = 0
+        self._commanded = {}  # topic -> (last value sent successfully, when)
+        self._observed = {}  # topic -> state observed at the last dispatch
+        self._last_cycle = {}
+        self._last_set_points = {}  # topic -> value of every set point of the last batch, sent or not
+        self._totals = {'sent': 0, 'suppressed': 0, 'coalesced': 0, 'failed': 0}
+
+    @contextmanager
+    def collecting(self):
+        """
+        Collects the set points issued in the block and dispatches them when it exits.
+        Not reentrant: the caller serializes the strategy runs.
+        """
+        if self._batch is not None:
+            raise RuntimeError('A set point batch is already being collected')
+        self._batch = OrderedDict()
+        self._collected = 0
+        try:
+            yield self
+        finally:
+            batch, self._batch = self._batch, None
+            self.dispatch(batch)
+
+    def call(self, peer, method, *args, **kwargs):
+        """
+        Records a set_point while collecting, otherwise sends any call right away.
+
+        :returns: an AsyncResult, like ``vip.rpc.call``
+        """
+        if self._batch is None or method != SET_POINT:
+            return self._vip.rpc.call(peer, method, *args, **kwargs)
+        # set_point(requester_id, topic, value, ...)
+        self._batch[(peer, args[1])] = (args, kwargs)
+        self._collected += 1
+        result = AsyncResult()
+        result.set(args[2])
+        return result
+
+    def _is_transition(self, topic, value):
+        observed = self._state_of(topic)
+        self._observed[topic] = observed
+        commanded = self._commanded.get(topic)
+        if commanded is not None and time.monotonic() - commanded[1] < self._settle:
+            # Sent recently, the device may not have reported it yet: the last command is its state
+            return commanded[0] != value
+        if observed is not None:
+            return observed != value
+        return commanded is None or commanded[0] != value
+
+    def dispatch(self, batch):
+        """
+        Sends the state transitions of a batch of set points.
+        """
+        started = time.monotonic()
+        self._last_set_points = {args[1]: args[2] for args, kwargs in batch.values()}
+        pending = [(peer, args, kwargs) for (peer, topic), (args, kwargs) in batch.items()
+                   if self._is_transition(topic, args[2])]
+        latencies = []
+        failed = []
+
+        def send(command):
+            peer, args, kwargs = command
+            sent = time.monotonic()
+            try:
+                self._vip.rpc.call(peer, SET_POINT, *args, **kwargs).get(timeout=self._timeout)
+                latencies.append(time.monotonic() - sent)
+                self._commanded[args[1]] = (args[2], time.monotonic())
+            except (gevent.Timeout, Exception):
+                failed.append(args[1])
+
+        if pending:
+            Pool(self._concurrency).map(send, pending)
+        self._last_cycle = {'commands': len(batch),
+                            'sent': len(pending) - len(failed),
+                            'suppressed': len(batch) - len(pending),
+                            'coalesced': self._collected - len(batch),
+                            'failed': failed,
+                            'cycle_latency': time.monotonic() - started,
+                            'max_latency': max(latencies) if latencies else 0.0,
+                            'mean_latency': sum(latencies) / len(latencies) if latencies else 0.0}
+        for name in ('sent', 'suppressed', 'coalesced'):
+            self._totals[name] += self._last_cycle[name]
+        self._totals['failed'] += len(failed)
+        return self._last_cycle
+
+    def stats(self):
+        """
+        :returns: counts and latencies (seconds) of the last dispatched batch
+        :rtype: dict
+        """
+        return dict(self._last_cycle)
+
+    def totals(self):
+        """
+        :returns: sent / suppressed / coalesced / failed set points since the agent started
+        :rtype: dict
+        """
+        return dict(self._totals)
+
+    def set_points(self):
+        """
+        :returns: ``{topic: value}`` of the set points issued in the last batch, suppressed ones included
+        :rtype: dict
+        """
+        return dict(self._last_set_points)
+
+    def commanded(self):
+        """
+        :returns: ``{topic: last value sent successfully}``
+        :rtype: dict
+        """
+        return {topic: commanded[0] for topic, commanded in self._commanded.items()}
+
+    def states(self):
+        """
+        :returns: ``{topic: (last commanded value, state observed at the last dispatch)}``
+        :rtype: dict
+        """
+        return {topic: (self._commanded.get(topic, (None,))[0], observed) for topic, observed in self._observed.items()}
+
+
+class ActuatorProxy(object):
+    """
+    Stands in for the agent VIP object of a device: ``rpc.call`` goes through
+    the batcher, everything else to the real VIP object.
+    """
+
+    def __init__(self, vip, batcher):
+        self._vip = vip
+        self.rpc = _RPCProxy(vip.rpc, batcher)
+
+    def __getattr__(self, name):
+        return getattr(self._vip, name)
+
+
+class _RPCProxy(object):
+
+    def __init__(self, rpc, batcher):
+        self._rpc = rpc
+        self._batcher = batcher
+
+    def call(self, peer, method, *args, **kwargs):
+        return self._batcher.call(peer, method, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._rpc, name)
@@ -6,11 +6,17 @@ __docformat__ = 'reStructuredText'
 
 import logging
 import sys
+import time
+from collections import deque
+import gevent
+import numpy as np
+from gevent.event import Event
+from gevent.lock import BoundedSemaphore
 from volttron.platform.agent import utils
 from volttron.platform.vip.agent import Agent, Core, RPC
+from volttron.platform.messaging import headers as headers_mod
 import sys
 sys.path.append("/home/sanka/NIRE_EMS/volttron/LoadPriorityControl/LPCv1/")
-import sqlite3
 
 from Model.SmartPlug import SmartPlug
 from Model.IoTDeviceGroup import IoTDeviceGroup
@@ -28,9 +34,24 @@ from Model.GroupRepository import GroupRepository
 from Model.EVCharger import EVCharger
 from Controller.EvMonitor import EvMonitor
 
+from .actuation import ActuatorProxy, CommandBatcher
+from .compact import COMPACT_TOPIC, EV_POINTS, CompactEncoder, point_values
+from .consumption import RunningConsumption
+from .device_config import DeviceConfigRepository
+from .dispatch import DEVICES_PREFIX, TopicIndex
+from .ingest import IngestQueue
+from .lpc_kernel import OFF, ON_STATUSES, decide
+from .rollup import EV_PRIORITY, ROLLUP_TOPIC, build_rollup, thresholds_from_command
+from .scheduler import ControlScheduler
+from .shards import merge_consumption
+from .spool import SnapshotSpool
+
 _log = logging.getLogger(__name__)
+EV_SWITCH_STATUS = {2: 1, 1: OFF} # EV charger status (2 charging, 1 occupied not charging) -> on / off, no car otherwise
+UNKNOWN_STATUS = -1 # status of a device that has not reported one, not switchable for the kernel
 utils.setup_logging()
-conn = sqlite3.connect('/home/sanka/NIRE_EMS/volttron/FacadeAgent/Device_configure_database.sqlite')
+DEVICE_DB_PATH = '/home/sanka/NIRE_EMS/volttron/FacadeAgent/Device_configure_database.sqlite'
+SPOOL_PATH = '/home/sanka/NIRE_EMS/volttron/FacadeAgent/Facade_spool.sqlite'
 __version__ = "0.1"
 
 
@@ -54,8 +75,18 @@ def facadeAgent(config_path, **kwargs):
 
     setting1 = int(config.get('setting1', 1))
     setting2 = config.get('setting2', "some/random/topic")
+    ingest_capacity = int(config.get('ingest_capacity', 256))
+    ingest_batch = int(config.get('ingest_batch', 16))
+    control = config.get('control', {})
+    device_reload_interval = int(config.get('device_reload_interval', 30))
+    sharding = config.get('sharding', {})
+    actuation = config.get('actuation', {})
+    spool = config.get('spool', {})
+    compact = config.get('compact', {})
+    lpc_shadow = bool(config.get('lpc_shadow', False))
 
-    return Facadeagent(setting1, setting2, **kwargs)
+    return Facadeagent(setting1, setting2, ingest_capacity, ingest_batch, control, device_reload_interval, sharding,
+                       actuation, spool, compact, lpc_shadow, **kwargs)
 
 
 class Facadeagent(Agent):
@@ -63,7 +94,8 @@ class Facadeagent(Agent):
     Document agent constructor here.
     """
 
-    def __init__(self, setting1=1, setting2="some/random/topic", **kwargs):
+    def __init__(self, setting1=1, setting2="some/random/topic", ingest_capacity=256, ingest_batch=16, control=None, device_reload_interval=30, sharding=None,
+                 actuation=None, spool=None, compact=None, lpc_shadow=False, **kwargs):
         super(Facadeagent, self).__init__(**kwargs)
         _log.debug("vip_identity: " + self.core.identity)
 
@@ -76,54 +108,207 @@ class Facadeagent(Agent):
                                "setting2": setting2}
         # Loading parameters from the configuration database
         
-        self._conn = sqlite3.connect('/home/sanka/NIRE_EMS/volttron/FacadeAgent/Device_configure_database.sqlite')
-        self._cursor = self._conn.cursor()
-        self._cursor.execute("SELECT * FROM devices")
+        # Devices owned by this instance, every device unless the agent runs sharded
+        sharding = sharding or {}
+        self._device_configs = DeviceConfigRepository(DEVICE_DB_PATH, sharding.get('devices')) # re-read by reload_devices when the table changes
+        self._shard_peers = sharding.get('peers', []) # identities of the other shards, queried by get_Sharded_Consumption
+        self._shard_timeout = sharding.get('timeout', 5)
+        self._rollup_topic = ROLLUP_TOPIC + '/' + self.core.identity if sharding.get('devices') else ROLLUP_TOPIC
+        self._compact_topic = COMPACT_TOPIC + '/' + self.core.identity if sharding.get('devices') else COMPACT_TOPIC
+        compact = compact or {}
+        self._compact = CompactEncoder(**compact.get('encoder', {}))
+        self._control_command = None # last control command received, sent with the compact payload
+        self._lmp_topic = compact.get('lmp_topic') # LMP publishes, must be covered by a setting2 prefix
+        self._lmp = None # last LMP received on _lmp_topic
+        self._ev_points = {} # last raw EV charger points (EV_POINTS), sent with the compact payload
+        self._nested_interval = compact.get('nested_interval', 600) # seconds between two nested snapshots outside the commands
+        self._last_nested = None
+
+        # Publishes of the cycles where the store is unreachable, replayed when it is back
+        spool = dict(spool or {})
+        self._publish_timeout = spool.pop('publish_timeout', 10)
+        self._replay_batches = spool.pop('replay_batches', 2) # spool batches replayed per publish cycle
+        self._spool = SnapshotSpool(spool.pop('path', SPOOL_PATH), **spool)
+        self._store_ok = True
+        self._replaying = False
         self._group_mode_selector=0 # 0: run controller on the entire facade  1: run controllers on each priority groups
-        rows = self._cursor.fetchall()  
-        for row in rows:
-            print(row[0])
-        self._cursor.close()
-        self._conn.close()
+        self._priority_command = None # last command of execute_Control_by_Priority_Groups
+        configs = list(self._device_configs.load().values())
+        for config in configs:
+            print(config.device_id)
         self._command ={'building540/NIRE_WeMo_CC_1/w1':1,'building540/NIRE_WeMo_CC_1/w1':0,'building540/NIRE_WeMo_CC_1/w1':1,'building540/NIRE_WeMo_CC_1/w1':0}
         
         self._groupManager = IoTDeviceGroupManager()
 
         self._group = IoTDeviceGroup() # Group Facade
-        self._monitor = DeviceMonitor() # Monitor for smart plug update
         self._eVmonitor = EvMonitor() # Monitor for EV charging station
+        self._control_monitor = DeviceMonitor() # Monitor for the publishes outside devices/, e.g. control/building540
+        self._topic_index = TopicIndex() # device id -> monitor observed by that device only
+        self._unmatched_topics = set() # topics of the unmatched publishes already reported
+        self._consumption = RunningConsumption() # facade and priority group totals, updated per publish
+        # Devices actuate through the proxy, so the set points of one strategy run are sent as a batch
+        self._commands = CommandBatcher(self.vip, self._observed_state, **(actuation or {}))
+        self._actuator = ActuatorProxy(self.vip, self._commands)
+        self._control_lock = BoundedSemaphore(1) # one strategy run, and one set point batch, at a time
         self._emscontroller = EMSControl()
         #self._emscontroller.set_Controller(LoadPriorityControl(),{'1':3000})
         self._emscontroller.set_Controller(LoadPriorityControlEV(),{'1':3000})
         self._emscontroller.set_Group(self._group)
+        self._thresholds = {'total': 3000} # active threshold per group, reported in the rollup
+        self._lpc_active = True # facade strategy is LoadPriorityControlEV
+        self._lpc_shadow = lpc_shadow # compare every LoadPriorityControlEV run with the kernel, costs a decision per run
+        self._lpc_parity = {'runs': 0, 'agreeing': 0, 'disagreements': 0, 'last': []}
+
+        # Publishes are queued by _handle_publish and fed to the monitors by _consume_publishes
+        self._ingest = IngestQueue(ingest_capacity)
+        self._passthrough = deque() # control and LMP publishes, each one processed in arrival order
+        self._ingest_batch = ingest_batch
+        self._ingest_ready = Event()
+        self._ingest_dropped = 0
+
+        # Runs dowork when a group leaves its threshold band, at the latest every max_interval seconds
+        self._scheduler = ControlScheduler(self.dowork, **(control or {}))
+        self._scheduler.set_thresholds(self._thresholds)
         
         """Assign smart Plugs to the Group Facade
         """    
-        self._smart_plugs={}
-        for row in rows:
-            plug=SmartPlug(row[0],self.vip)
-            plug._max_power_rating=row[1]
-            plug._power_multiply_factor=row[5]
-            self._group.add_Device(plug)
-            self._monitor.register_Observer(plug)
-            self._smart_plugs[row]=plug
-        self.ev_charger= EVCharger('building540/EV/JuiceBox',self.vip)
-        self._group.add_Device(self.ev_charger)
-        self._eVmonitor.register_Observer(self.ev_charger)
+        self._smart_plugs={} # device id -> (DeviceConfig, SmartPlug)
+        self._devices={} # device id -> SmartPlug / EVCharger
+        for config in configs:
+            self._add_device(config)
+        self.ev_charger=None
+        if self._device_configs.owns('building540', 'EV'):
+            self.ev_charger= EVCharger('building540/EV/JuiceBox',self._actuator)
+            self._group.add_Device(self.ev_charger)
+            self._eVmonitor.register_Observer(self.ev_charger)
+            self._topic_index.register('building540/EV/JuiceBox', self._eVmonitor)
+            self._devices['building540/EV/JuiceBox']=self.ev_charger
+            self._consumption.add('building540/EV/JuiceBox', EV_PRIORITY)
         """Updating Observers to update power consumption of each plug
         """
         self._groupManager.add_Group( self._group)
-        self._groupManager.group_By_Priority()
-        self._monitor.set_EMS_Controller(self._groupManager)
+        self._control_monitor.set_EMS_Controller(self._groupManager)
+        self._priority_groups = None # priority -> IoTDeviceGroup, built on first use
+        self.priority_groups()
         ##
         # Set a default configuration to ensure that self.configure is called immediately to setup
         # the agent.
-        self.core.periodic(120,self.dowork)
+        self.core.periodic(1,self._scheduler.tick)
         self.core.periodic(40,self.publish)
+        self.core.periodic(device_reload_interval,self.reload_devices)
         self.vip.config.set_default("config", self.default_config)
         # Hook self.configure up to changes to the configuration file "config".
         self.vip.config.subscribe(self.configure, actions=["NEW", "UPDATE"], pattern="config")
 
+    def _device_monitor(self, plug):
+        """
+        Monitor notifying a single plug, so a publish only wakes the plug it belongs to.
+        """
+        monitor = DeviceMonitor()
+        monitor.register_Observer(plug)
+        monitor.set_EMS_Controller(self._groupManager)
+        return monitor
+
+    def _add_device(self, config):
+        plug=SmartPlug(config.device_id,self._actuator)
+        plug._max_power_rating=config.max_power_rating
+        plug._power_multiply_factor=config.power_multiply_factor
+        self._group.add_Device(plug)
+        self._topic_index.register(config.device_id, self._device_monitor(plug))
+        self._smart_plugs[config.device_id]=(config, plug)
+        self._devices[config.device_id]=plug
+        self._consumption.add(config.device_id, config.priority)
+
+    def _remove_device(self, config):
+        """
+        :returns: False when the facade group could not drop the plug and must be rebuilt
+        """
+        config, plug=self._smart_plugs.pop(config.device_id)
+        del self._devices[config.device_id]
+        self._topic_index.unregister(config.device_id)
+        self._consumption.remove(config.device_id)
+        remove_device = getattr(self._group, 'remove_Device', None)
+        if remove_device is None:
+            return False
+        remove_device(plug)
+        return True
+
+    def _rebuild_group(self):
+        """
+        Rebuilds the facade group and its manager from the current devices, for
+        IoTDeviceGroup versions that cannot remove a device.
+        """
+        self._group = IoTDeviceGroup()
+        for device in self._devices.values():
+            self._group.add_Device(device)
+        self._groupManager = IoTDeviceGroupManager()
+        self._groupManager.add_Group(self._group)
+        self._emscontroller.set_Group(self._group)
+        for device_id, monitor in self._topic_index.monitors():
+            if monitor is not self._eVmonitor:
+                monitor.set_EMS_Controller(self._groupManager)
+        self._control_monitor.set_EMS_Controller(self._groupManager)
+
+    def reload_devices(self):
+        """
+        Applies the changes of the devices table to the live facade, without a restart.
+
+        Max power and multiply factor are updated on the existing plug. A plug whose
+        controller, building or priority changed is rebuilt, since those are read when
+        the SmartPlug is created. The priority partition is rebuilt after any change.
+        """
+        try:
+            self._reload_devices()
+        except Exception:
+            _log.exception("Reloading the device table failed")
+
+    def _reload_devices(self):
+        changes = self._device_configs.changes()
+        if changes is None:
+            return
+        added, removed, updated = changes
+        removed_from_group = True
+        for config in removed:
+            removed_from_group &= self._remove_device(config)
+        for old, config in updated:
+            if (old.controller_id, old.building_id, old.priority) != (config.controller_id, config.building_id, config.priority):
+                removed_from_group &= self._remove_device(old)
+                self._add_device(config)
+            else:
+                plug=self._smart_plugs[config.device_id][1]
+                plug._max_power_rating=config.max_power_rating
+                plug._power_multiply_factor=config.power_multiply_factor
+                self._smart_plugs[config.device_id]=(config, plug)
+        for config in added:
+            self._add_device(config)
+        if not removed_from_group:
+            _log.info("IoTDeviceGroup cannot remove devices, rebuilding the facade group")
+            self._rebuild_group()
+        if not (added or removed or updated):
+            return
+        _log.info("Device table reloaded: {} added, {} removed, {} updated".format(len(added), len(removed), len(updated)))
+        self.invalidate_priority_groups()
+        if self._priority_command is not None:
+            self._apply_priority_command(self._priority_command)
+        else:
+            self.priority_groups()
+
+    def priority_groups(self):
+        """
+        Priority partition of the facade. Device priorities only change with the
+        configuration database, so it is built once and reused by every control
+        command until invalidate_priority_groups() is called.
+        """
+        if self._priority_groups is None:
+            self._priority_groups = self._groupManager.group_By_Priority()
+        return self._priority_groups
+
+    def invalidate_priority_groups(self):
+        """
+        To be called when devices are added or removed or a device priority changes.
+        """
+        self._priority_groups = None
+
     def configure(self, config_name, action, contents):
         """
         Called after the Agent has connected to the message bus. If a configuration exists at startup
@@ -163,23 +348,233 @@ class Facadeagent(Agent):
 
     def _handle_publish(self, peer, sender, bus, topic, headers, message):
         """
-        Callback triggered by the subscription setup using the topic from the agent's config file
+        Callback triggered by the subscription setup using the topic from the agent's config file.
+        Only queues the message, the monitors are updated by _consume_publishes. Device telemetry
+        is coalesced per topic, the other publishes are neither coalesced nor dropped.
         """
+        if topic.startswith(DEVICES_PREFIX):
+            self._ingest.put(topic, (topic, message))
+        else:
+            self._passthrough.append((topic, message))
+        self._ingest_ready.set()
 
+    def _consume_publishes(self):
+        """
+        Consumer greenlet: drains the pending control publishes and the ingestion queue in
+        batches and yields to the pubsub and RPC handlers between batches.
+        """
+        while True:
+            self._ingest_ready.wait()
+            self._ingest_ready.clear()
+            while self._passthrough or len(self._ingest):
+                batch = [self._passthrough.popleft() for _ in range(min(len(self._passthrough), self._ingest_batch))]
+                batch.extend(self._ingest.drain(self._ingest_batch - len(batch)))
+                for topic, message in batch:
+                    try:
+                        self._process_publish(topic, message)
+                    except Exception:
+                        _log.exception("Failed to process the publish on {}".format(topic))
+                gevent.sleep(0)
+            # Once per drained burst, not per message. Only flags a run, the periodic tick executes it
+            try:
+                self._scheduler.observe(self.group_power())
+            except Exception:
+                _log.exception("Failed to check the consumption against the thresholds")
+
+    def _process_publish(self, topic, message):
+        if self._lmp_topic and topic.startswith(self._lmp_topic):
+            lmp = message if isinstance(message, (int, float)) else point_values(message, ('lmp',)).get('lmp')
+            if lmp is not None:
+                self._lmp = lmp
+            return
+        device_id = self._topic_index.dispatch(topic, message)
+        if device_id is not None:
+            device = self._devices[device_id]
+            self._consumption.update(device_id, device.get_Power())
+            if device is self.ev_charger:
+                self._ev_points.update(point_values(message, EV_POINTS))
+            return
         if "/EV/" in topic :
             self._eVmonitor.process_Message({'topic':topic, 'message':message})
-        else:
-            self._monitor.process_Message({'topic':topic, 'message':message})
+            return
+        if not topic.startswith(DEVICES_PREFIX):
+            self._control_monitor.process_Message({'topic':topic, 'message':message})
+            return
+        # Every plug observes its own monitor only, a publish matching no registered device reaches nobody
+        if topic not in self._unmatched_topics and len(self._unmatched_topics) < 1000:
+            self._unmatched_topics.add(topic)
+            _log.warning("Publish on {} matches no registered device, dropped".format(topic))
 
     def dowork(self):
-        if self._group_mode_selector==1:
-            self._groupManager.execute_Strategy()
-        elif self._group_mode_selector==0:
-            self._emscontroller.execute_Strategy()
+        """
+        Runs the active strategy and sends its set points as one batch. Runs started from the
+        tick periodic and from the control RPCs wait for each other.
+
+        The devices saw their batched commands accepted. When some failed, the strategy is
+        run again once min_interval allows, on the state the devices reported since.
+        """
+        with self._control_lock:
+            # Kernel decision on the state the strategy runs on, compared with its set points afterwards
+            shadow = self._lpc_decision() if self._lpc_shadow and self._group_mode_selector == 0 and self._lpc_active else None
+            with self._commands.collecting():
+                if self._group_mode_selector==1:
+                    self._groupManager.execute_Strategy()
+                elif self._group_mode_selector==0:
+                    self._emscontroller.execute_Strategy()
+            stats = self._commands.stats()
+            if shadow is not None:
+                self._compare_lpc(shadow, self._commands.set_points())
+        if stats['failed']:
+            _log.warning("Set point failed for {}, running the strategy again".format(stats['failed']))
+            self._scheduler.request()
+        _log.debug("Actuation: {}".format(stats))
+
+    def _observed_state(self, topic):
+        """
+        Last reported status of the plug a set point topic belongs to, as the set point value it
+        matches: 1 for on and standby, 0 for off. None for other devices and other statuses.
+        """
+        device_id, _ = self._topic_index.lookup(topic)
+        if device_id is None or device_id not in self._smart_plugs:
+            return None
+        status = self._smart_plugs[device_id][1].get_Status()
+        if status in ON_STATUSES:
+            return 1
+        if status == OFF:
+            return 0
+        return None
+
+    def _device_fields(self, device_ids=None):
+        """
+        Per-device arrays for the compact payload and the kernel: power and priority from the
+        running consumption, status from the device objects, rated power from the device configuration.
+
+        :param device_ids: order of the entries, every device in registration order when None
+        :returns: (device ids, ``{'power', 'priority', 'status', 'max_power': array}``)
+        """
+        device_ids = list(self._devices) if device_ids is None else list(device_ids)
+        power, priority = zip(*(self._consumption.device(device_id) for device_id in device_ids)) if device_ids else ((), ())
+        fields = {'power': np.array(power, dtype=np.float64), 'priority': np.array(priority, dtype=np.int64)}
+        statuses = (self._devices[device_id].get_Status() for device_id in device_ids)
+        fields['status'] = np.fromiter((UNKNOWN_STATUS if status is None else status for status in statuses),
+                                       dtype=np.int16, count=len(device_ids))
+        ratings = (self._smart_plugs[device_id][0].max_power_rating if device_id in self._smart_plugs else None
+                   for device_id in device_ids)
+        fields['max_power'] = np.fromiter((np.nan if rating is None else rating for rating in ratings),
+                                          dtype=np.float64, count=len(device_ids))
+        return device_ids, fields
         
     def publish(self):
-        self.smart_Plug_Data_service.create_and_store_smart_plug_json(self._group)
-        
+        self._consumption.resync()
+        # The compact payload carries every cycle, the nested snapshot is stored on the control
+        # commands and every nested_interval seconds
+        if self._last_nested is None or time.monotonic() - self._last_nested >= self._nested_interval:
+            self.store_nested()
+        now = utils.format_timestamp(utils.get_aware_utc_now())
+        # The spooled cycles go out before this one, so the store receives the history in order.
+        # While any are left this cycle is spooled behind them.
+        if len(self._spool) and not self._replaying:
+            self.replay_spool()
+        self.publish_rollup(now)
+        self.publish_compact(now)
+        self.report_ingest()
+
+    def store_nested(self):
+        """
+        Stores the nested Monitor snapshot of the facade.
+        """
+        self._last_nested = time.monotonic()
+        try:
+            self.smart_Plug_Data_service.create_and_store_smart_plug_json(self._group)
+        except Exception:
+            _log.exception("Storing the nested facade snapshot failed")
+
+    def _publish(self, timestamp, topic, message):
+        headers = {headers_mod.DATE: timestamp, headers_mod.TIMESTAMP: timestamp}
+        self.vip.pubsub.publish('pubsub', topic, headers=headers, message=message).get(timeout=self._publish_timeout)
+
+    def _send(self, timestamp, topic, message):
+        """
+        Publishes, or spools the message while the store is unreachable.
+        """
+        if self._store_ok:
+            try:
+                self._publish(timestamp, topic, message)
+                return
+            except Exception as e:
+                _log.warning("Publish on {} failed ({}), spooling the publishes".format(topic, e))
+                self._store_ok = False
+        self._spool.append(timestamp, topic, message)
+
+    def replay_spool(self):
+        """
+        Replays replay_batches batches of the spooled publishes, with their original timestamps, so a long
+        backlog does not hold up the publish cycle. The dashboards and the exporter fill the cycles missing
+        from the compact stream with the replayed payloads. The store is back once the spool is empty.
+        """
+        self._replaying = True
+        try:
+            self._spool.replay(self._publish, pause=lambda: gevent.sleep(0), max_batches=self._replay_batches)
+            self._store_ok = not len(self._spool)
+        except Exception as e:
+            _log.warning("Spool replay interrupted ({}), {} publishes left".format(e, len(self._spool)))
+            self._store_ok = False
+        finally:
+            self._replaying = False
+        _log.info("Spool replay: {}".format(self._spool.stats()))
+
+    def publish_compact(self, now):
+        """
+        Publish the compact payload: the device layout when it changed or is due again, then
+        the power, status and last command of every device in layout order.
+        """
+        device_ids, fields = self._device_fields(list(self._devices))
+        commands = {}
+        for topic, value in self._commands.commanded().items():
+            device_id, _ = self._topic_index.lookup(topic)
+            if device_id is not None:
+                commands[device_id] = value
+        self._compact.set_devices([device_id, priority, None if max_power != max_power else max_power]
+                                  for device_id, priority, max_power
+                                  in zip(device_ids, fields['priority'].tolist(), fields['max_power'].tolist()))
+        ev = None
+        if self.ev_charger is not None:
+            ev = dict(self._ev_points, power=self.ev_charger.get_Power(), energy=self.ev_charger.get_Energy(),
+                      status=self.ev_charger.get_Status())
+        messages = self._compact.encode(fields['power'].tolist(),
+                                        [None if status == UNKNOWN_STATUS else status for status in fields['status'].tolist()],
+                                        [commands.get(device_id) for device_id in device_ids],
+                                        self._control_command, self._lmp, ev)
+        for message in messages:
+            self._send(now, self._compact_topic, message)
+
+    def report_ingest(self):
+        """
+        Log the ingestion queue depth and counters, as a warning when publishes were dropped since the last report.
+        """
+        stats = self._ingest.stats()
+        if stats['dropped'] > self._ingest_dropped:
+            _log.warning("Ingestion queue dropped {} publishes: {}".format(stats['dropped'] - self._ingest_dropped, stats))
+        else:
+            _log.debug("Ingestion queue: {}".format(stats))
+        self._ingest_dropped = stats['dropped']
+
+    def group_power(self):
+        """
+        Power per priority group and of the whole facade ('total'), from the running totals.
+        """
+        priority_power = self._consumption.groups()
+        priority_power['total'] = self._consumption.total()
+        return priority_power
+
+    def publish_rollup(self, now):
+        """
+        Publish the compact rollup record (totals, power and threshold per priority group, set point
+        counters, EV metrics) so consumers do not have to re-derive them from the facade JSON.
+        """
+        rollup = build_rollup(self._consumption.groups(), self.ev_charger, self._thresholds, self._commands.totals())
+        self._send(now, self._rollup_topic, rollup)
+
         
     @Core.receiver("onstart")
     def onstart(self, sender, **kwargs):
@@ -195,7 +590,7 @@ class Facadeagent(Agent):
 
         # Example RPC call
         # self.vip.rpc.call("some_agent", "some_method", arg1, arg2)
-        pass
+        self.core.spawn(self._consume_publishes)
 
     @Core.receiver("onstop")
     def onstop(self, sender, **kwargs):
@@ -203,7 +598,8 @@ class Facadeagent(Agent):
         This method is called when the Agent is about to shutdown, but before it disconnects from
         the message bus.
         """
-        pass
+        self._device_configs.close()
+        self._spool.close()
 
     @RPC.export
     def rpc_method(self, arg1, arg2, kwarg1=None, kwarg2=None):
@@ -216,11 +612,145 @@ class Facadeagent(Agent):
     
     @RPC.export
     def get_Facades_Consumption(self,sender)->dict:
-        return self._group.get_Facade_Consumption()
+        """
+        Facade consumption from the running totals, without walking the devices of the group.
+        """
+        return {'total': self._consumption.total(), 'priority': self._consumption.groups()}
+
+    @RPC.export
+    def get_Group_Consumption(self)->dict:
+        """
+        Running power totals of the facade and of each priority group, without walking the devices.
+        """
+        return self.get_Facades_Consumption(None)
+
+    @RPC.export
+    def get_Sharded_Consumption(self)->dict:
+        """
+        Coordinator view: running totals of this shard and of every peer shard, queried
+        concurrently. Peers not answering within the shard timeout are listed as unavailable.
+        """
+        calls = {peer: self.vip.rpc.call(peer, 'get_Group_Consumption') for peer in self._shard_peers}
+        gevent.wait(list(calls.values()), timeout=self._shard_timeout)
+        results = {self.core.identity: self.get_Group_Consumption()}
+        for peer, call in calls.items():
+            if call.ready() and call.successful():
+                results[peer] = call.get()
+            else:
+                _log.warning("Shard {} did not report its consumption".format(peer))
+                results[peer] = None
+        return merge_consumption(results)
+
+    @RPC.export
+    def get_Actuation_Stats(self)->dict:
+        """
+        Set points collected, sent, suppressed and failed in the last strategy run, with latencies in seconds,
+        and the counters since start.
+        """
+        return dict(self._commands.stats(), totals=self._commands.totals())
+
+    @RPC.export
+    def get_Command_States(self)->dict:
+        """
+        Last commanded value and last observed state of every actuated point.
+        """
+        return self._commands.states()
+
+    def _lpc_decision(self):
+        """
+        Kernel decision on the current device state and thresholds.
+
+        :returns: (device ids, status, Decision), None when no threshold is active
+        """
+        if not self._thresholds:
+            return None
+        device_ids, fields = self._device_fields()
+        status = fields['status']
+        if self.ev_charger is not None and 'building540/EV/JuiceBox' in device_ids:
+            ev = device_ids.index('building540/EV/JuiceBox')
+            status[ev] = EV_SWITCH_STATUS.get(int(status[ev]), -1)
+        threshold = self._thresholds.get('total', self._thresholds)
+        return device_ids, status, decide(fields['power'], fields['priority'], status, fields['max_power'], threshold)
+
+    def _compare_lpc(self, shadow, set_points):
+        """
+        Compares the kernel decision taken before a LoadPriorityControlEV run with the set points the
+        strategy issued. A plug the strategy commanded must end in the kernel state, a plug it left alone
+        must keep it. Only switchable plugs are compared, the EV charger set points are not on / off.
+        """
+        device_ids, status, decision = shadow
+        commanded = {}
+        for topic, value in set_points.items():
+            device_id, _ = self._topic_index.lookup(topic)
+            if device_id in self._smart_plugs:
+                try:
+                    commanded[device_id] = int(value) != OFF
+                except (TypeError, ValueError):
+                    pass
+        disagreeing = []
+        for device_id, current, on in zip(device_ids, status.tolist(), decision.on.tolist()):
+            if device_id not in self._smart_plugs or (current != OFF and current not in ON_STATUSES):
+                continue
+            if commanded.get(device_id, current in ON_STATUSES) != on:
+                disagreeing.append(device_id)
+        parity = self._lpc_parity
+        parity['runs'] += 1
+        parity['agreeing'] += not disagreeing
+        parity['disagreements'] += len(disagreeing)
+        parity['last'] = disagreeing
+        if disagreeing:
+            _log.info("LPC kernel disagrees with LoadPriorityControlEV on {} plugs: {}".format(
+                len(disagreeing), disagreeing[:10]))
+
+    @RPC.export
+    def get_LPC_Decision(self)->dict:
+        """
+        Load priority decision of the vectorized kernel on the current device state and thresholds,
+        None when no threshold is active.
+
+        The kernel implements the documented load priority rule, it is not LoadPriorityControlEV.
+        ``parity`` counts, over the strategy runs so far, the runs where the strategy set points
+        matched the kernel decision taken on the same state, and the plugs where they did not.
+        It stays empty unless the agent runs with ``lpc_shadow``.
+        """
+        started = time.monotonic()
+        shadow = self._lpc_decision()
+        if shadow is None:
+            return None
+        device_ids, status, decision = shadow
+        return {'on': [device_id for device_id, on in zip(device_ids, decision.on) if on],
+                'switch_on': [device_id for device_id, on in zip(device_ids, decision.switch_on) if on],
+                'switch_off': [device_id for device_id, off in zip(device_ids, decision.switch_off) if off],
+                'load': decision.load,
+                'seconds': time.monotonic() - started,
+                'parity': dict(self._lpc_parity, last=list(self._lpc_parity['last']))}
+
+    @RPC.export
+    def get_Spool_Stats(self)->dict:
+        """
+        Spooled publishes waiting for the store, eviction and replay counters, last replay throughput.
+        """
+        return dict(self._spool.stats(), store_ok=self._store_ok)
+
+    @RPC.export
+    def get_Ingest_Stats(self)->dict:
+        """
+        Ingestion queue depth and received / coalesced / dropped / processed counters,
+        plus the dispatched / unmatched publish counts and the pending control publishes.
+        """
+        return dict(self._ingest.stats(), dispatch=self._topic_index.stats(), passthrough=len(self._passthrough))
+
+    @RPC.export
+    def get_Control_Stats(self)->dict:
+        """
+        Strategy runs, pending trigger and zone of each controlled group.
+        """
+        return self._scheduler.stats()
     
     @RPC.export
     def update_control_command(self,cmd:dict,sender):
         self.smart_Plug_Data_service.store_Control_Commands(cmd,str(sender))
+        self._control_command = cmd
         self.smart_Plug_Data_service.create_and_store_smart_plug_json(self._group)       
     
     @RPC.export
@@ -231,22 +761,37 @@ class Facadeagent(Agent):
         Then it asssign the control stratagy for the each group
         """
         self.smart_Plug_Data_service.store_Control_Commands(cmd,str(sender))
+        self._control_command = cmd
         self.smart_Plug_Data_service.create_and_store_smart_plug_json(self._group)
         self._group_mode_selector=1
-        print("Recived Control Command>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>",self._groupManager.group_By_Priority())
-        priorityGroups=self._groupManager.group_By_Priority()
+        self._thresholds = thresholds_from_command(cmd)
+        self._scheduler.set_thresholds(self._thresholds)
+        self._priority_command = cmd
+        self._apply_priority_command(cmd)
+        self._scheduler.run()
+
+    def _apply_priority_command(self, cmd):
+        """
+        Assigns the control strategy of each priority group, also after the partition was rebuilt.
+        """
+        priorityGroups=self.priority_groups()
+        print("Recived Control Command>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>",priorityGroups)
         self._groupManager.clear_Groups_Stratgies()
         for key in cmd.keys(): 
             print("Recived Control Command>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>",priorityGroups[int(key)],cmd)
             self._groupManager.set_Group_Stratagy(priorityGroups[int(key)],cmd[key])
-        self._groupManager.execute_Strategy()
         
         
     @RPC.export
     def execute_Control_all_Groups(self,cmd:dict,sender)->None:
         self.smart_Plug_Data_service.store_Control_Commands(cmd,str(sender))
+        self._control_command = cmd
         self.smart_Plug_Data_service.create_and_store_smart_plug_json(self._group)
         self._group_mode_selector=0  
+        self._priority_command = None
+        self._lpc_active = cmd[0]=='lpc'
+        self._thresholds = thresholds_from_command(cmd)
+        self._scheduler.set_thresholds(self._thresholds)
         if cmd[0]=='direct':
             self._emscontroller.set_Controller(DirectControl(),cmd)
         elif cmd[0]=='increment':
@@ -256,7 +801,7 @@ class Facadeagent(Agent):
         elif cmd[0]=='lpc':
    #         self._emscontroller.set_Controller(LoadPriorityControl(),cmd)
             self._emscontroller.set_Controller(LoadPriorityControlEV(),cmd)
-        self._emscontroller.execute_Strategy()        
+        self._scheduler.run()
         
 
 
@@ -0,0 +1,99 @@
+"""
+Compact, schema versioned facade payload.
+
+The nested Monitor JSON repeats the static fields of every device (priority,
+max power) on every publish. The compact payload sends them once in a
+layout message, and every publish cycle only dense power / status arrays in
+layout order. The format is described in Telemetry_compact.py, whose
+SnapshotDecoder reads it for the dashboards and the history exporter.
+
+It is the snapshot stored every publish cycle, *instead of* the nested JSON:
+SmartPlugDataService only writes the nested JSON on the control commands and
+every ``nested_interval`` seconds. The LMP comes from the ``lmp_topic``
+publishes. The readers take the compact snapshots and fall back to the
+nested ones for the history older than the compact topic.
+
+It is published on a ``record/`` topic, so the historian stores every
+message whole instead of splitting the dict into points.
+"""
+
+__docformat__ = 'reStructuredText'
+
+import hashlib
+import json
+import time
+
+COMPACT_TOPIC = 'record/building540/FacadeCompact'
+SCHEMA_VERSION = 1  # the only definition, Telemetry_compact.py imports it
+EV_POINTS = ('voltage', 'current', 'frequency', 'temperature')  # raw EV charger points carried in the payload
+
+
+def point_values(message, names):
+    """
+    Values of the named points of a device publish, matched case insensitively.
+
+    :param message: ``[{point: value}, {point: metadata}]`` of an ``all`` publish, or ``{point: value}``
+    :param names: lower case point names
+    :rtype: dict
+    """
+    if isinstance(message, list) and message:
+        message = message[0]
+    if not isinstance(message, dict):
+        return {}
+    return {point.lower(): value for point, value in message.items() if point.lower() in names}
+
+
+class CompactEncoder(object):
+    """
+    :param layout_interval: seconds between two repetitions of an unchanged layout,
+                            so readers starting later find it in their time window
+    :param clock: monotonic clock in seconds
+    """
+
+    def __init__(self, layout_interval=600, clock=time.monotonic):
+        self._layout_interval = layout_interval
+        self._clock = clock
+        self._devices = None
+        self._layout = None
+        self._layout_sent = None
+
+    def set_devices(self, devices):
+        """
+        :param devices: ``[[identifier, priority, maxpower], ...]`` in the order of the snapshot arrays
+        """
+        devices = [list(device) for device in devices]
+        if devices == self._devices:
+            return
+        self._devices = devices
+        self._layout = hashlib.sha1(json.dumps(devices).encode()).hexdigest()[:12]
+        self._layout_sent = None
+
+    def encode(self, power, status, command=None, cmd=None, lmp=None, ev=None):
+        """
+        Builds the messages of one publish cycle: the layout message when it
+        changed or is due again, then the snapshot.
+
+        :param power: power of every layout device, None when unknown
+        :param status: status of every layout device
+        :param command: last command sent to every layout device, None when none was sent
+        :param cmd: active control command
+        :param lmp: last LMP, left out when None
+        :param ev: EV charger metrics
+        :rtype: list
+        """
+        messages = []
+        now = self._clock()
+        if self._layout_sent is None or now - self._layout_sent >= self._layout_interval:
+            messages.append({'schema': SCHEMA_VERSION, 'layout': self._layout, 'devices': self._devices})
+            self._layout_sent = now
+        snapshot = {'schema': SCHEMA_VERSION,
+                    'layout': self._layout,
+                    'power': [None if value is None else round(value, 2) for value in power],
+                    'status': list(status),
+                    'command': list(command) if command is not None else [None] * len(status),
+                    'cmd': cmd,
+                    'ev': ev}
+        if lmp is not None:
+            snapshot['LMP'] = lmp
+        messages.append(snapshot)
+        return messages
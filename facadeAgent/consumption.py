@@ -0,0 +1,79 @@
+"""
+Running consumption totals of the facade and its priority groups.
+
+Summing ``get_Power()`` over every device on each query is O(devices). The
+totals here are updated by the difference between the new and the previous
+power of a device when it reports, so reading the facade or a priority
+group consumption is O(1). :meth:`RunningConsumption.resync` recomputes
+the totals from the stored device powers, to bound floating point drift.
+"""
+
+__docformat__ = 'reStructuredText'
+
+
+class RunningConsumption(object):
+
+    def __init__(self):
+        self._power = {}  # device id -> last reported power
+        self._priority = {}  # device id -> priority group
+        self._group_power = {}  # priority -> W
+        self._total = 0.0
+
+    def add(self, device_id, priority, power=0.0):
+        self.remove(device_id)
+        self._power[device_id] = power
+        self._priority[device_id] = priority
+        self._group_power[priority] = self._group_power.get(priority, 0.0) + power
+        self._total += power
+
+    def remove(self, device_id):
+        if device_id not in self._power:
+            return
+        power = self._power.pop(device_id)
+        priority = self._priority.pop(device_id)
+        self._group_power[priority] -= power
+        self._total -= power
+
+    def set_priority(self, device_id, priority):
+        """
+        Moves a device to another priority group, keeping its power.
+        """
+        self.add(device_id, priority, self._power.get(device_id, 0.0))
+
+    def update(self, device_id, power):
+        """
+        Applies the power change of a registered device.
+        """
+        power = power or 0.0
+        delta = power - self._power[device_id]
+        if delta:
+            self._power[device_id] = power
+            priority = self._priority[device_id]
+            self._group_power[priority] += delta
+            self._total += delta
+
+    def device(self, device_id):
+        """
+        :returns: (last reported power, priority group) of a registered device
+        :rtype: tuple
+        """
+        return self._power[device_id], self._priority[device_id]
+
+    def total(self):
+        return self._total
+
+    def group(self, priority):
+        return self._group_power.get(priority, 0.0)
+
+    def groups(self):
+        """
+        :returns: ``{priority: W}``
+        :rtype: dict
+        """
+        return dict(self._group_power)
+
+    def resync(self):
+        self._group_power = dict.fromkeys(self._group_power, 0.0)
+        for device_id, power in self._power.items():
+            self._group_power[self._priority[device_id]] += power
+        self._total = sum(self._power.values())
@@ -0,0 +1,179 @@
+"""
+Typed repository of the device configuration (devices table of
+Device_configure_database.sqlite).
+
+Rows are read into :class:`DeviceConfig` records instead of positional
+tuples. Lookups by building, controller and priority are SQL queries served
+by the indexes of the table, created when the repository opens the database
+if it does not have them yet (the names of Database_write.prepare_database).
+
+A shard (``{'building_id': [...]}`` or ``{'controller_id': [...]}``) limits
+the repository to the devices owned by one agent instance.
+
+The shard is re-read only when another connection committed to the
+database since the last check (``PRAGMA data_version``), and the new
+records are diffed against the previous read, so the agent can add, remove
+or update the affected plugs without a restart.
+"""
+
+__docformat__ = 'reStructuredText'
+
+import logging
+import sqlite3
+
+_log = logging.getLogger(__name__)
+
+COLUMNS = ('device_id', 'max_power_rating', 'controller_id', 'building_id', 'priority', 'power_multiply_factor')
+SHARD_COLUMNS = ('building_id', 'controller_id')
+INDEXED_COLUMNS = ('building_id', 'controller_id', 'priority')
+
+
+class DeviceConfig(object):
+    """
+    Configuration of one device.
+
+    :param device_id: full identifier, ``building540/NIRE_WeMo_cc_1/w1``
+    :param max_power_rating: rated power, W
+    :param controller_id: controller the device is wired to
+    :param building_id: building of the device
+    :param priority: priority group
+    :param power_multiply_factor: factor applied to the reported power
+    """
+
+    __slots__ = COLUMNS
+
+    def __init__(self, device_id: str, max_power_rating: float, controller_id: str, building_id: str, priority: int,
+                 power_multiply_factor: float):
+        self.device_id = device_id
+        self.max_power_rating = max_power_rating
+        self.controller_id = controller_id
+        self.building_id = building_id
+        self.priority = priority
+        self.power_multiply_factor = power_multiply_factor
+
+    def _values(self):
+        return tuple(getattr(self, column) for column in COLUMNS)
+
+    def __eq__(self, other):
+        return isinstance(other, DeviceConfig) and self._values() == other._values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return 'DeviceConfig({})'.format(', '.join('{}={!r}'.format(column, getattr(self, column)) for column in COLUMNS))
+
+
+class DeviceConfigRepository(object):
+    """
+    :param db_path: path of Device_configure_database.sqlite
+    :param shard: ``{column: [values]}`` with column one of :data:`SHARD_COLUMNS`,
+                  None for every device
+    """
+
+    def __init__(self, db_path, shard=None):
+        self._db_path = db_path
+        self._where = []
+        self._params = []
+        self._shard = {}
+        for column, values in (shard or {}).items():
+            if column not in SHARD_COLUMNS:
+                raise ValueError('Cannot shard devices by {}, use one of {}'.format(column, SHARD_COLUMNS))
+            values = sorted(set(values)) # duplicates would leave placeholders without a parameter
+            self._shard[column] = set(values)
+            self._where.append('{} IN ({})'.format(column, ', '.join('?' * len(values))))
+            self._params.extend(values)
+        self._connection = None
+        self._data_version = None
+        self._devices = {}
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._db_path)
+            try:
+                with self._connection:
+                    for column in INDEXED_COLUMNS:
+                        self._connection.execute('CREATE INDEX IF NOT EXISTS idx_devices_{0} ON devices ({0})'.format(column))
+            except sqlite3.OperationalError as e:
+                # e.g. a read-only database: the lookups still work, by scanning the table
+                _log.warning("Cannot index the devices table of {} ({})".format(self._db_path, e))
+        return self._connection
+
+    def _select(self, where=None, params=()):
+        conditions = self._where + ([where] if where else [])
+        query = 'SELECT {} FROM devices{} ORDER BY rowid'.format(
+            ', '.join(COLUMNS), ' WHERE ' + ' AND '.join(conditions) if conditions else '')
+        return [DeviceConfig(*row) for row in self._connect().execute(query, self._params + list(params))]
+
+    def load(self):
+        """
+        Reads every device of the shard.
+
+        :returns: ``{device_id: DeviceConfig}`` in table order
+        :rtype: dict
+        """
+        self._data_version = self._connect().execute('PRAGMA data_version').fetchone()[0]
+        self._devices = {device.device_id: device for device in self._select()}
+        return dict(self._devices)
+
+    def get(self, device_id):
+        """
+        :returns: the configuration of a device of the shard, None when unknown
+        :rtype: DeviceConfig
+        """
+        devices = self._select('device_id = ?', (device_id,))
+        return devices[0] if devices else None
+
+    def by_building(self, building_id):
+        """
+        :rtype: list[DeviceConfig]
+        """
+        return self._select('building_id = ?', (building_id,))
+
+    def by_controller(self, controller_id):
+        """
+        :rtype: list[DeviceConfig]
+        """
+        return self._select('controller_id = ?', (controller_id,))
+
+    def by_priority(self, priority):
+        """
+        :rtype: list[DeviceConfig]
+        """
+        return self._select('priority = ?', (priority,))
+
+    def owns(self, building_id, controller_id):
+        """
+        Whether a device outside the table (e.g. the EV charger) belongs to this shard.
+
+        :rtype: bool
+        """
+        device = {'building_id': building_id, 'controller_id': controller_id}
+        return all(device[column] in values for column, values in self._shard.items())
+
+    def changes(self):
+        """
+        Diffs the shard against the previous read.
+
+        :returns: (added, removed, updated (old, new) pairs) of DeviceConfig,
+                  None when nothing was committed since the previous read
+        :rtype: tuple
+        """
+        data_version = self._connect().execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return None
+        previous = self._devices
+        current = self.load()
+        added = [device for device_id, device in current.items() if device_id not in previous]
+        removed = [device for device_id, device in previous.items() if device_id not in current]
+        updated = [(previous[device_id], device) for device_id, device in current.items()
+                   if device_id in previous and previous[device_id] != device]
+        return added, removed, updated
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
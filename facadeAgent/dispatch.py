@@ -0,0 +1,73 @@
+"""
+Topic indexed dispatch of the device publishes.
+
+A single DeviceMonitor notifies every registered observer of every message,
+so each publish costs O(devices) and a full publish cycle O(devices^2).
+Here every device gets its own monitor with the device as its only
+observer, and the monitors are indexed by device id. A message is handed to
+the monitor of its device only, found with a dict lookup on the topic.
+"""
+
+__docformat__ = 'reStructuredText'
+
+DEVICES_PREFIX = 'devices/'
+
+
+class TopicIndex(object):
+    """
+    Device id (``building540/NIRE_WeMo_cc_1/w1``) to monitor index.
+    """
+
+    def __init__(self):
+        self._monitors = {}
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._monitors)
+
+    def register(self, device_id, monitor):
+        self._monitors[device_id] = monitor
+
+    def unregister(self, device_id):
+        return self._monitors.pop(device_id, None)
+
+    def monitors(self):
+        """
+        :returns: (device id, monitor) of every registered device
+        :rtype: list
+        """
+        return list(self._monitors.items())
+
+    def lookup(self, topic):
+        """
+        Finds the device a topic belongs to.
+
+        :param topic: ``devices/<device id>/all`` or ``devices/<device id>/<point>``
+        :returns: (device id, monitor), (None, None) when no registered device matches
+        :rtype: tuple
+        """
+        device_id = topic[len(DEVICES_PREFIX):] if topic.startswith(DEVICES_PREFIX) else topic
+        # Longest registered prefix wins, the cost only depends on the topic depth
+        monitor = self._monitors.get(device_id)
+        while monitor is None and '/' in device_id:
+            device_id = device_id.rsplit('/', 1)[0]
+            monitor = self._monitors.get(device_id)
+        return (device_id, monitor) if monitor is not None else (None, None)
+
+    def dispatch(self, topic, message):
+        """
+        Hands a publish to the monitor of its device.
+
+        :returns: the device id, None when no registered device matches the topic
+        """
+        device_id, monitor = self.lookup(topic)
+        if monitor is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        monitor.process_Message({'topic': topic, 'message': message})
+        return device_id
+
+    def stats(self):
+        return {'devices': len(self._monitors), 'hits': self._hits, 'misses': self._misses}
@@ -0,0 +1,78 @@
+"""
+Bounded ingestion queue for the device publishes.
+
+The pubsub callback only records the latest message of each device topic and
+returns; a consumer greenlet drains the queue in small batches and feeds the
+monitors. A device publishing again before its previous message was consumed
+replaces it (latest wins), so a burst of publishes costs one update per
+device. When more distinct topics are pending than the capacity allows, the
+oldest pending message is dropped.
+"""
+
+__docformat__ = 'reStructuredText'
+
+from collections import OrderedDict
+
+
+class IngestQueue(object):
+    """
+    Latest-wins queue keyed by device topic.
+
+    :param capacity: maximum number of pending device topics
+    """
+
+    def __init__(self, capacity=256):
+        self._capacity = capacity
+        self._pending = OrderedDict()
+        self._max_depth = 0
+        self._received = 0
+        self._coalesced = 0
+        self._dropped = 0
+        self._processed = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, key, item):
+        """
+        Queues the latest item of a device.
+
+        :returns: False when the item replaced a pending item of the same device
+        :rtype: bool
+        """
+        self._received += 1
+        if key in self._pending:
+            # Keeps the queue position, so a chatty device does not starve the others
+            self._pending[key] = item
+            self._coalesced += 1
+            return False
+        if len(self._pending) >= self._capacity:
+            self._pending.popitem(last=False)
+            self._dropped += 1
+        self._pending[key] = item
+        self._max_depth = max(self._max_depth, len(self._pending))
+        return True
+
+    def drain(self, max_items):
+        """
+        Removes and returns up to max_items pending items, oldest first.
+
+        :rtype: list
+        """
+        batch = []
+        while self._pending and len(batch) < max_items:
+            batch.append(self._pending.popitem(last=False)[1])
+        self._processed += len(batch)
+        return batch
+
+    def stats(self):
+        """
+        :returns: current depth and counters since the agent started
+        :rtype: dict
+        """
+        return {'depth': len(self._pending),
+                'max_depth': self._max_depth,
+                'received': self._received,
+                'coalesced': self._coalesced,
+                'dropped': self._dropped,
+                'processed': self._processed}
@@ -0,0 +1,83 @@
+"""
+Compact rollup of the facade state.
+
+The full facade JSON stored by SmartPlugDataService is convenient for
+debugging but every consumer has to re-derive the totals from it. The rollup
+is a flat record of numeric points (total power, power per priority group,
+active thresholds and EV metrics) published next to it, so the historian
+stores one numeric topic per point.
+"""
+
+__docformat__ = 'reStructuredText'
+
+import logging
+
+_log = logging.getLogger(__name__)
+
+ROLLUP_TOPIC = 'analysis/building540/FacadeRollup'
+EV_PRIORITY = 0  # the EV charger is reported in the differable group
+FACADE_STRATEGIES = ('direct', 'increment', 'shed', 'lpc')  # cmd[0] of execute_Control_all_Groups
+
+
+def _threshold(value):
+    if isinstance(value, bool) or value is None:
+        raise ValueError('threshold {!r} is not a number'.format(value))
+    return float(value)
+
+
+def thresholds_from_command(cmd):
+    """
+    Converts a control command into the threshold per group it activates.
+
+    :param cmd: ``{'1': ('simplecontrol', 300), ...}`` or ``{'1': 300, ...}`` for priority
+                group control, ``['lpc', 3000]`` for facade wide control
+    :returns: ``{priority: threshold}`` or ``{'total': threshold}``, None when
+              the command does not have one of these shapes
+    :rtype: dict
+    """
+    try:
+        if isinstance(cmd, dict):
+            return {int(priority): _threshold(value[1] if isinstance(value, (list, tuple)) and len(value) == 2 else value)
+                    for priority, value in cmd.items()}
+        if isinstance(cmd, (list, tuple)) and len(cmd) == 2 and cmd[0] in FACADE_STRATEGIES:
+            return {'total': _threshold(cmd[1])}
+    except (TypeError, ValueError) as e:
+        _log.warning("Control command {!r} carries no usable threshold: {}".format(cmd, e))
+        return None
+    _log.warning("Control command {!r} carries no threshold".format(cmd))
+    return None
+
+
+def build_rollup(priority_power, ev_charger, thresholds, actuation=None):
+    """
+    Builds the rollup record.
+
+    :param priority_power: ``{priority: W}``, the EV charger counted in :data:`EV_PRIORITY`
+    :param ev_charger: EVCharger of the facade, None when another shard owns it
+    :param thresholds: active thresholds, see :func:`thresholds_from_command`
+    :param actuation: set point counters since start, ``{'sent': n, 'suppressed': n, ...}``
+    :returns: [points, meta] as expected by the historian
+    :rtype: list
+    """
+    points = {'total_power': sum(priority_power.values())}
+    meta = {'total_power': {'type': 'float', 'units': 'W'}}
+    for priority, power in sorted(priority_power.items()):
+        points[f'priority_{priority}_power'] = power
+        meta[f'priority_{priority}_power'] = {'type': 'float', 'units': 'W'}
+    for group, threshold in (thresholds or {}).items():
+        name = 'total_threshold' if group == 'total' else f'priority_{group}_threshold'
+        points[name] = threshold
+        meta[name] = {'type': 'float', 'units': 'W'}
+    for counter, count in (actuation or {}).items():
+        points[f'commands_{counter}'] = count
+        meta[f'commands_{counter}'] = {'type': 'integer', 'units': 'count'}
+    if ev_charger is None:
+        return [points, meta]
+
+    points['ev_power'] = ev_charger.get_Power() or 0.0
+    points['ev_energy'] = ev_charger.get_Energy()
+    points['ev_status'] = ev_charger.get_Status()
+    meta['ev_power'] = {'type': 'float', 'units': 'W'}
+    meta['ev_energy'] = {'type': 'float', 'units': 'Wh'}
+    meta['ev_status'] = {'type': 'integer', 'units': 'enum'}
+    return [points, meta]
@@ -0,0 +1,137 @@
+"""
+Event driven control scheduling.
+
+The active strategy used to run on a fixed 120 s period, whatever the
+consumption did in between. The scheduler runs it when the power of a
+controlled group leaves its threshold band, and at the latest after
+``max_interval`` seconds.
+
+Every group is in one of three zones: ``high`` above its threshold, ``low``
+more than ``band`` (fraction of the threshold) below it, ``ok`` in between.
+A zone must hold for ``debounce`` seconds before it counts, so a single
+noisy reading does not trigger a run. Entering ``high`` or ``low`` triggers
+a run; staying ``high`` triggers again every ``min_interval`` seconds until
+the breach is corrected. Two runs are never closer than ``min_interval``.
+
+:meth:`ControlScheduler.observe` only records the trigger, so the caller
+(the ingestion consumer) never waits for the strategy. The run itself
+happens in :meth:`ControlScheduler.tick`, called from its own periodic.
+"""
+
+__docformat__ = 'reStructuredText'
+
+import logging
+import time
+
+_log = logging.getLogger(__name__)
+
+HIGH = 'high'
+OK = 'ok'
+LOW = 'low'
+
+
+class ControlScheduler(object):
+    """
+    :param execute: callable running the active strategy
+    :param band: width of the ``ok`` zone below a threshold, as a fraction of it
+    :param debounce: seconds a zone must hold before it counts
+    :param min_interval: minimum seconds between two runs
+    :param max_interval: maximum seconds between two runs
+    :param clock: monotonic clock in seconds
+    """
+
+    def __init__(self, execute, band=0.05, debounce=5, min_interval=10, max_interval=120, clock=time.monotonic):
+        self._execute = execute
+        self._band = band
+        self._debounce = debounce
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._clock = clock
+        self._thresholds = {}
+        self._zones = {}  # group -> zone acted upon
+        self._candidates = {}  # group -> (zone, first seen)
+        self._pending = False
+        self._last_run = clock()
+        self._runs = 0
+        self._failures = 0
+
+    def set_thresholds(self, thresholds):
+        """
+        :param thresholds: ``{priority: threshold}`` or ``{'total': threshold}``, see
+                           :func:`facadeAgent.rollup.thresholds_from_command`
+        """
+        self._thresholds = dict(thresholds or {})
+        self._zones = {}
+        self._candidates = {}
+
+    def _zone(self, power, threshold):
+        if power > threshold:
+            return HIGH
+        if power < threshold * (1 - self._band):
+            return LOW
+        return OK
+
+    def observe(self, power):
+        """
+        Checks the consumption against the thresholds and records a trigger.
+        The strategy is run by the next :meth:`tick`.
+
+        :param power: ``{priority: W}`` including ``'total'``
+        :returns: True when a run is pending
+        :rtype: bool
+        """
+        now = self._clock()
+        for group, threshold in self._thresholds.items():
+            if threshold is None or power.get(group) is None:
+                continue
+            zone = self._zone(power[group], threshold)
+            candidate = self._candidates.get(group)
+            if candidate is None or candidate[0] != zone:
+                self._candidates[group] = candidate = (zone, now)
+            if now - candidate[1] < self._debounce:
+                continue
+            if zone != self._zones.get(group, OK):
+                self._pending = self._pending or zone != OK
+                self._zones[group] = zone
+            elif zone == HIGH:
+                self._pending = True
+        return self._pending
+
+    def tick(self):
+        """
+        Runs a pending trigger once min_interval allows it, or the strategy
+        when it did not run for max_interval. Call it periodically.
+
+        :returns: True when the strategy ran
+        :rtype: bool
+        """
+        since = self._clock() - self._last_run
+        if (self._pending and since >= self._min_interval) or since >= self._max_interval:
+            self.run()
+            return True
+        return False
+
+    def request(self):
+        """
+        Asks for another run as soon as min_interval allows it, e.g. after failed set points.
+        """
+        self._pending = True
+
+    def run(self):
+        """
+        Runs the strategy now, e.g. right after a new control command. A failing
+        run is logged, the next one is due after min_interval.
+        """
+        self._pending = False
+        self._last_run = self._clock()
+        self._runs += 1
+        try:
+            self._execute()
+        except Exception:
+            self._failures += 1
+            self._pending = True
+            _log.exception("Control strategy run failed")
+
+    def stats(self):
+        return {'runs': self._runs, 'failures': self._failures, 'pending': self._pending, 'zones': dict(self._zones),
+                'seconds_since_run': round(self._clock() - self._last_run, 1)}
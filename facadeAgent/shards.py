@@ -0,0 +1,40 @@
+"""
+Aggregation of the facade consumption across sharded agent instances.
+
+Each instance owns the devices of its shard (see
+:class:`facadeAgent.device_config.DeviceConfigRepository`) and runs its own control
+loop, so a slow building does not stall the others. The coordinator asks
+every peer for its running totals concurrently and merges the answers; a
+peer that does not answer in time is reported as unavailable instead of
+failing the whole query.
+"""
+
+__docformat__ = 'reStructuredText'
+
+
+def merge_consumption(results):
+    """
+    Merges the ``get_Group_Consumption`` answers of the shards.
+
+    :param results: ``{identity: {'total': W, 'priority': {priority: W}}}``,
+                    None for a shard that did not answer
+    :returns: facade total, total per priority group and the answer of each shard
+    :rtype: dict
+    """
+    total = 0.0
+    priority_power = {}
+    available = []
+    unavailable = []
+    for identity, consumption in sorted(results.items()):
+        if consumption is None:
+            unavailable.append(identity)
+            continue
+        available.append(identity)
+        total += consumption['total']
+        # Priorities come back as strings from the peers (JSON keys)
+        for priority, power in consumption['priority'].items():
+            priority_power[str(priority)] = priority_power.get(str(priority), 0.0) + power
+    return {'total': total,
+            'priority': priority_power,
+            'shards': {identity: results[identity] for identity in available},
+            'unavailable': unavailable}
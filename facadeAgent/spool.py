@@ -0,0 +1,133 @@
+"""
+Local write-ahead spool of the facade publishes.
+
+While the store behind the facade snapshots is unreachable, the publishes
+of every cycle are appended to a SQLite file in WAL mode instead of being
+lost. When the store is back, they are replayed oldest first, a few
+batches per publish cycle and with their original timestamps; the cycles
+published until the spool is empty are appended behind them.
+The spool is capped in size; past the cap the oldest entries are evicted
+first.
+
+The spooled compact payloads are what the readers use for the outage: the
+dashboards (Telemetry_cache.py), the exporter and the rollup backfill fill
+the cycles missing from the compact stream with them.
+"""
+
+__docformat__ = 'reStructuredText'
+
+import json
+import sqlite3
+import time
+
+
+class SnapshotSpool(object):
+    """
+    :param path: SQLite file of the spool
+    :param max_bytes: cap of the spooled payloads, in bytes
+    :param batch_size: entries read and deleted per replay batch
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, batch_size=500):
+        self._max_bytes = max_bytes
+        self._batch_size = batch_size
+        self._connection = sqlite3.connect(path)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS spool (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                size INTEGER NOT NULL
+            )
+        ''')
+        self._connection.commit()
+        self._depth, self._bytes = self._connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM spool').fetchone()
+        self._spooled = 0
+        self._evicted = 0
+        self._replayed = 0
+        self._last_replay = {}
+
+    def __len__(self):
+        return self._depth
+
+    def append(self, ts, topic, message):
+        """
+        Spools one publish, evicting the oldest entries past the size cap.
+
+        :param ts: formatted timestamp of the publish
+        """
+        payload = json.dumps(message)
+        with self._connection:
+            self._connection.execute('INSERT INTO spool (ts, topic, payload, size) VALUES (?, ?, ?, ?)',
+                                     (ts, topic, payload, len(payload)))
+            self._depth += 1
+            self._bytes += len(payload)
+            self._spooled += 1
+            while self._bytes > self._max_bytes and self._depth > 1:
+                self._evict_oldest()
+
+    def _evict_oldest(self):
+        rows = self._connection.execute('SELECT seq, size FROM spool ORDER BY seq LIMIT ?', (self._batch_size,)).fetchall()
+        evict = []
+        for seq, size in rows:
+            if self._bytes <= self._max_bytes:
+                break
+            evict.append((seq,))
+            self._bytes -= size
+        self._connection.executemany('DELETE FROM spool WHERE seq = ?', evict)
+        self._depth -= len(evict)
+        self._evicted += len(evict)
+
+    def replay(self, send, pause=None, max_batches=None):
+        """
+        Replays the spool oldest first, one batch per transaction. Stops at the
+        first failing send, or after max_batches, and keeps the remaining entries
+        for the next replay.
+
+        :param send: callable(ts, topic, message), raises when the store is unreachable
+        :param pause: optional callable run between two batches, e.g. to yield to other greenlets
+        :param max_batches: optional bound on the batches replayed by this call
+        :returns: number of entries replayed
+        :rtype: int
+        """
+        started = time.monotonic()
+        replayed = 0
+        batches = 0
+        try:
+            while self._depth and (max_batches is None or batches < max_batches):
+                batches += 1
+                rows = self._connection.execute('SELECT seq, ts, topic, payload, size FROM spool ORDER BY seq LIMIT ?',
+                                                (self._batch_size,)).fetchall()
+                sent = []
+                try:
+                    for seq, ts, topic, payload, size in rows:
+                        send(ts, topic, json.loads(payload))
+                        sent.append((seq, size))
+                finally:
+                    with self._connection:
+                        self._connection.executemany('DELETE FROM spool WHERE seq = ?', [(seq,) for seq, size in sent])
+                    self._depth -= len(sent)
+                    self._bytes -= sum(size for seq, size in sent)
+                    replayed += len(sent)
+                if pause is not None:
+                    pause()
+        finally:
+            elapsed = time.monotonic() - started
+            self._replayed += replayed
+            self._last_replay = {'entries': replayed, 'seconds': round(elapsed, 3),
+                                 'per_second': round(replayed / elapsed, 1) if elapsed else None}
+        return replayed
+
+    def stats(self):
+        """
+        :returns: depth, size, spooled / evicted / replayed counters and the throughput of the last replay
+        :rtype: dict
+        """
+        return {'depth': self._depth, 'bytes': self._bytes, 'spooled': self._spooled, 'evicted': self._evicted,
+                'replayed': self._replayed, 'last_replay': dict(self._last_replay)}
+
+    def close(self):
+        self._connection.close()
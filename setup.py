@@ -18,7 +18,7 @@ setup(
     author="sanka.liyanage",
     author_email="sanka.liyanage@groupnire.com",
     description="This agent control the facade",
-    install_requires=['volttron'],
+    install_requires=['volttron', 'numpy'],
     packages=packages,
     entry_points={
         'setuptools.installation': [